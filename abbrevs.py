@@ -2,35 +2,211 @@
 abbrevs.py - check first occurence of an abbreviation in a text
 stream is its definition.
 
+    python abbrevs.py build/tmp/article.md
+    python abbrevs.py parts/*.md
+    python abbrevs.py <article.md
+
+Reads the files in one pass, reporting abbreviations which are never
+defined, or used before they're defined, with file:line locations.  A
+definition is the abbreviation just inside or just before parentheses,
+"Total Phosphorus (TP)" or "TP (Total Phosphorus)".  Only the first few
+uses of each abbreviation are kept, as context for the report, and text
+in ``` fenced code blocks is skipped.
+
+As a library, e.g. in a doit task with the files as file_dep, so the
+results are cached between builds:
+
+    def task_abbrevs():
+        return {
+            'actions': [(abbrevs.write_json, [files, 'build/abbrevs.json'])],
+            'file_dep': files,
+            'targets': ['build/abbrevs.json'],
+        }
+
 Terry N. Brown terrynbrown@gmail.com Fri Mar 15 13:08:21 EDT 2019
 """
 
+import argparse
+import io
+import json
 import re
 import sys
 
-from collections import defaultdict
-
 ABBREV_RE = r'\b[A-Z][A-Z0-9]+\b'
+CONTEXT = 3  # uses of each abbreviation kept for the report
+WIDTH = 60  # characters kept either side of an abbreviation
 
-abbr = defaultdict(list)
-first = {}
 search = re.compile(ABBREV_RE)
-last = None
-
-for line_n, line in enumerate(sys.stdin):
-    line = line.strip()
-    for match in search.finditer(line):
-        match = match.group()
-        if match not in first:
-            first[match] = line_n
-            abbr[match].append((line_n - 1, last or ''))
-        abbr[match].append((line_n, line))
-    last = line
-for match, line_n in sorted(first.items(), key=lambda x: x[1]):
-    text = (
-        "%s %s\n  %s"
-        % (line_n, match, '\n  '.join("%s %s" % i for i in abbr[match]))
+
+
+class AbbrevIndex(object):
+    """AbbrevIndex - first use and definition of each abbreviation in
+    a stream of lines, see feed()
+    """
+
+    def __init__(self, context=CONTEXT, ignore=()):
+        """
+        Args:
+            context (int): uses of each abbreviation to keep
+            ignore (list): abbreviations to ignore, e.g. 'USA'
+        """
+        self.context = context
+        self.ignore = set(ignore)
+        self.terms = {}  # abbreviation -> info, see add()
+        self.files = {}  # filename -> order fed
+
+    def feed(self, lines, filename='-'):
+        """feed - scan lines from a file
+
+        :param iterable lines: lines of text
+        :param str filename: name for locations
+        """
+        self.files.setdefault(filename, len(self.files))
+        fenced = False
+        for line_n, line in enumerate(lines, 1):
+            if line.lstrip().startswith('```'):
+                fenced = not fenced
+                continue
+            if fenced:
+                continue
+            for match in search.finditer(line):
+                term = match.group()
+                if term not in self.ignore:
+                    self.add(term, filename, line_n, line, match)
+
+    def add(self, term, filename, line_n, line, match):
+        """add - record a use of term"""
+        info = self.terms.get(term)
+        if info is None:
+            info = self.terms[term] = {
+                'first': [filename, line_n],
+                'defined': None,
+                'uses': 0,
+                'context': [],
+            }
+        info['uses'] += 1
+        if info['defined'] is None:
+            before = line[: match.start()].rstrip()
+            after = line[match.end():].lstrip()
+            if before.endswith('(') or after.startswith('('):
+                info['defined'] = [filename, line_n]
+        if len(info['context']) < self.context:
+            start = max(0, match.start() - WIDTH)
+            text = line[start: match.end() + WIDTH].strip()
+            info['context'].append([filename, line_n, text])
+
+    def problems(self):
+        """problems - undefined and late defined abbreviations, in order
+        of first use
+
+        :return: [(term, 'undefined' or 'late', info), ...]
+        :rtype: list
+        """
+        ans = []
+        for term, info in self.terms.items():
+            if info['defined'] is None:
+                ans.append((term, 'undefined', info))
+            elif info['defined'] != info['first']:
+                ans.append((term, 'late', info))
+        ans.sort(
+            key=lambda x: (self.files[x[2]['first'][0]], x[2]['first'][1])
+        )
+        return ans
+
+    def report(self, highlight=False):
+        """report - text report of problems()
+
+        :param bool highlight: highlight abbreviations for a terminal
+        :return: report
+        :rtype: str
+        """
+        lines = []
+        for term, kind, info in self.problems():
+            if kind == 'undefined':
+                lines.append(
+                    "%s:%d: %s used %d times, never defined"
+                    % (info['first'][0], info['first'][1], term, info['uses'])
+                )
+            else:
+                lines.append(
+                    "%s:%d: %s used before definition at %s:%d"
+                    % (
+                        info['first'][0],
+                        info['first'][1],
+                        term,
+                        info['defined'][0],
+                        info['defined'][1],
+                    )
+                )
+            for filename, line_n, text in info['context']:
+                if highlight:
+                    text = text.replace(term, "\x1B[7m%s\x1B[27m" % term)
+                lines.append("  %s:%d: %s" % (filename, line_n, text))
+        return '\n'.join(lines)
+
+
+def scan(paths, context=CONTEXT, ignore=()):
+    """scan - index abbreviations in files, in order
+
+    :param list paths: paths to files, '-' for stdin
+    :param int context: uses of each abbreviation to keep
+    :param list ignore: abbreviations to ignore
+    :return: index
+    :rtype: AbbrevIndex
+    """
+    index = AbbrevIndex(context=context, ignore=ignore)
+    for path in paths:
+        if path == '-':
+            index.feed(sys.stdin, path)
+        else:
+            with io.open(path, encoding='utf-8', errors='replace') as in_:
+                index.feed(in_, path)
+    return index
+
+
+def write_json(paths, out_path, context=CONTEXT, ignore=()):
+    """write_json - scan() files and save the index and problems as JSON,
+    for a doit action
+
+    :param list paths: paths to files
+    :param str out_path: path for JSON output
+    :param int context: uses of each abbreviation to keep
+    :param list ignore: abbreviations to ignore
+    :return: True, for doit
+    :rtype: bool
+    """
+    index = scan(paths, context=context, ignore=ignore)
+    with open(out_path, 'w') as out:
+        json.dump(
+            {
+                'terms': index.terms,
+                'problems': [[i[0], i[1]] for i in index.problems()],
+            },
+            out,
+            indent=2,
+            sort_keys=True,
+        )
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report abbreviations not defined at first use"
+    )
+    parser.add_argument(
+        'files', nargs='*', default=['-'], help="files, default stdin"
+    )
+    parser.add_argument(
+        '--context', type=int, default=CONTEXT,
+        help="uses of each abbreviation to show",
     )
-    if 1:
-        text = text.replace(match, "\x1B[7m%s\x1B[27m" % match)
-    print(text)
+    parser.add_argument(
+        '--ignore', nargs='+', default=[], help="abbreviations to ignore"
+    )
+    opt = parser.parse_args()
+    index = scan(opt.files, context=opt.context, ignore=opt.ignore)
+    print(index.report(highlight=sys.stdout.isatty()))
+
+
+if __name__ == '__main__':
+    main()
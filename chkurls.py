@@ -1,15 +1,30 @@
 """
 chkurls.py - check urls in a text stream work.
 
+    python chkurls.py <references.md
+
+URLs are checked concurrently, with an asyncio event loop running
+requests in a thread pool, one requests.Session (connection pool) per
+host, limits on total and per host concurrency, timeouts, and retries
+with exponential backoff.  HEAD requests servers reject are retried as
+GET.  Results are cached in .url.chl.json, working URLs for 90 days and
+failures for a day, and the cache is saved every few seconds, so an
+interrupted run isn't wasted.  Requires Python 3.
+
 Terry N. Brown terrynbrown@gmail.com Fri Mar 15 13:08:21 EDT 2019
 """
 
+import argparse
+import asyncio
 import json
 import os
 import re
 import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
 import requests
 
 URL_RE = (
@@ -18,12 +33,12 @@ URL_RE = (
 )
 CACHE = ".url.chl.json"
 GOOD_RESPONSE = 200, 302
+TTL = 90 * 24 * 60 * 60  # seconds before working URLs are rechecked
+NEGATIVE_TTL = 24 * 60 * 60  # seconds before failed URLs are rechecked
+# HEAD statuses retried with GET, for servers which don't handle HEAD
+GET_FALLBACK = 400, 403, 404, 405, 501
+RETRY_STATUS = 429, 500, 502, 503, 504  # statuses worth retrying
 
-if os.path.exists(CACHE):
-    cache = json.load(open(CACHE))
-else:
-    cache = {'url': {}}
-seen = set()
 search = re.compile(URL_RE)
 
 
@@ -33,43 +48,261 @@ def get_urls(stream):
             yield line_n+1, match.group()
 
 
-now = time.time()
-min_time = now - 90 * 24 * 60 * 60
+class LinkChecker(object):
+    """LinkChecker - check URLs concurrently, caching results"""
+
+    def __init__(
+        self,
+        cache_path=CACHE,
+        concurrency=20,
+        per_host=4,
+        timeout=10,
+        retries=2,
+        backoff=1.0,
+        ttl=TTL,
+        negative_ttl=NEGATIVE_TTL,
+        flush_interval=5,
+        verify=False,
+    ):
+        """
+        Args:
+            cache_path (str): path to JSON cache file
+            concurrency (int): max. requests at once
+            per_host (int): max. requests at once to one host
+            timeout (float): seconds to wait to connect, and for data
+            retries (int): retries after connection errors, timeouts,
+                and RETRY_STATUS responses
+            backoff (float): seconds before first retry, doubling after
+            ttl (float): seconds to cache working URLs
+            negative_ttl (float): seconds to cache failed URLs
+            flush_interval (float): seconds between cache saves
+            verify (bool): verify SSL certificates
+        """
+        self.cache_path = cache_path
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.flush_interval = flush_interval
+        self.verify = verify
+        self.sessions = {}  # requests.Session per host
+        self.dirty = False
+        self.cache = {'url': {}}
+        if os.path.exists(cache_path):
+            with open(cache_path) as in_:
+                self.cache = json.load(in_)
+
+    def cached(self, url, now=None):
+        """cached - cached result for url, if it's not expired
+
+        :param str url: URL
+        :param float now: time.time()
+        :return: {'time':, 'ok':, 'status':} or None
+        :rtype: dict
+        """
+        info = self.cache['url'].get(url)
+        if info is None:
+            return None
+        ttl = self.ttl if info['ok'] else self.negative_ttl
+        if info['time'] + ttl < (now or time.time()):
+            return None
+        return info
+
+    def flush(self):
+        """flush - save the cache, if changed, atomically"""
+        if not self.dirty:
+            return
+        with open(self.cache_path + '.tmp', 'w') as out:
+            json.dump(self.cache, out)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+        self.dirty = False
+
+    def request(self, method, url):
+        """request - blocking request, run in a worker thread
+
+        :param str method: 'HEAD' or 'GET'
+        :param str url: URL
+        :return: HTTP status
+        :rtype: int
+        """
+        host = urlsplit(url).netloc
+        session = self.sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.per_host
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session = self.sessions.setdefault(host, session)
+        # stream=True so GET doesn't download the body
+        response = session.request(
+            method,
+            url,
+            timeout=self.timeout,
+            verify=self.verify,
+            allow_redirects=False,
+            stream=True,
+        )
+        response.close()
+        return response.status_code
+
+    async def status(self, url):
+        """status - HTTP status for url, with retries and GET fallback
+
+        :param str url: URL
+        :return: (status, error), status 0 and error name if no response
+        :rtype: (int, str)
+        """
+        loop = asyncio.get_running_loop()
+        host = urlsplit(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        status, error = 0, None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                async with self.limit, self.host_limits[host]:
+                    status = await loop.run_in_executor(
+                        self.executor, self.request, 'HEAD', url
+                    )
+                    if status in GET_FALLBACK:
+                        status = await loop.run_in_executor(
+                            self.executor, self.request, 'GET', url
+                        )
+                error = None
+            except requests.exceptions.RequestException as exc:
+                status, error = 0, exc.__class__.__name__
+                continue
+            if status not in RETRY_STATUS:
+                break
+        return status, error
+
+    async def check(self, url):
+        """check - check url, or url without trailing punctuation, unless
+        the result is cached
 
+        :param str url: URL
+        :return: {'time':, 'ok':, 'status':, 'cached':}
+        :rtype: dict
+        """
+        info = self.cached(url)
+        if info is not None:
+            return dict(info, cached=True)
+        to_try = [url]
+        if url[-1] in '.,;':
+            to_try.append(url[:-1])
+        for url_i in to_try:
+            status, error = await self.status(url_i)
+            if status in GOOD_RESPONSE:
+                break
+        info = {'time': time.time(), 'ok': status in GOOD_RESPONSE}
+        info['status'] = error or status
+        self.cache['url'][url] = info
+        self.dirty = True
+        return dict(info, cached=False)
 
-def get_status_code(to_try):
-    for url in to_try:
+    async def check_all(self, urls):
+        """check_all - check urls concurrently, saving the cache
+        periodically
+
+        :param list urls: URLs
+        :return: check() result for each URL
+        :rtype: list
+        """
+        # created here, with the event loop running
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.host_limits = {}
+
+        async def flusher():
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self.flush()
+
+        flushing = asyncio.ensure_future(flusher())
+        try:
+            return await asyncio.gather(*[self.check(i) for i in urls])
+        finally:
+            flushing.cancel()
+            self.flush()
+
+    def run(self, urls):
+        """run - check_all() in a new event loop
+
+        :param list urls: URLs
+        :return: check() result for each URL
+        :rtype: list
+        """
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         try:
-            r = requests.head(url, verify=False)
-            status_code = r.status_code
-        except requests.exceptions.ConnectionError:
-            print("  ConnectionError")
-            status_code = 0
-        if status_code in GOOD_RESPONSE:
-            break
-    return status_code
-
-
-for line_n, url in get_urls(sys.stdin):
-    if url in seen:
-        continue
-    seen.add(url)
-    if url not in cache['url']:
-        cache['url'][url] = {'time': now, 'ok': False}
-    info = cache['url'][url]
-    if info['time'] > min_time and info['ok'] is True:
-        continue
-    to_try = [url]
-    if url[-1] in '.,;':
-        to_try.append(url[:-1])
-    status_code = get_status_code(to_try)
-    if status_code in GOOD_RESPONSE:
-        info['ok'] = True
-        info['time'] = now
-    else:
-        print(line_n, url)
-        info['ok'] = False
-        print("  %s status %s" % (url, status_code))
-
-with open(CACHE, 'w') as out:
-    json.dump(cache, out)
+            return loop.run_until_complete(self.check_all(urls))
+        finally:
+            self.executor.shutdown(wait=False)
+            loop.close()
+            for session in self.sessions.values():
+                session.close()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Check URLs in text on stdin work",
+    )
+    parser.add_argument('--cache', default=CACHE, help="cache file")
+    parser.add_argument(
+        '--concurrency', type=int, default=20, help="max. requests at once"
+    )
+    parser.add_argument(
+        '--per-host', type=int, default=4,
+        help="max. requests at once to one host",
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=10, help="request timeout, seconds"
+    )
+    parser.add_argument(
+        '--retries', type=int, default=2, help="retries for failures"
+    )
+    parser.add_argument(
+        '--negative-ttl', type=float, default=NEGATIVE_TTL,
+        help="seconds to cache failures, 0 to always recheck",
+    )
+    return parser
+
+
+def main(argv=None, stream=None):
+    opt = make_parser().parse_args(argv)
+    checker = LinkChecker(
+        cache_path=opt.cache,
+        concurrency=opt.concurrency,
+        per_host=opt.per_host,
+        timeout=opt.timeout,
+        retries=opt.retries,
+        negative_ttl=opt.negative_ttl,
+    )
+    found = []
+    seen = set()
+    for line_n, url in get_urls(stream or sys.stdin):
+        if url not in seen:
+            seen.add(url)
+            found.append((line_n, url))
+    results = checker.run([url for line_n, url in found])
+    failed = 0
+    for (line_n, url), info in zip(found, results):
+        if not info['ok']:
+            failed += 1
+            print(line_n, url)
+            print(
+                "  %s status %s%s"
+                % (url, info['status'], " (cached)" if info['cached'] else '')
+            )
+    return failed
+
+
+if __name__ == '__main__':
+    # failure count, but 256 failures mustn't wrap to exit status 0
+    sys.exit(min(main(), 1))
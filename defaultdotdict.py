@@ -4,7 +4,13 @@ DefaultDotDict - Yet another dictionary with dot notation.
 Supports loading from JSON.  Acts as defaultdict recursively
 adding more DefaultDotDicts when non-existent items are requested.
 
-See main() for a demo.
+Optionally tracks changes, see DefaultDotDict.track(), for saving
+only what's changed with json_journal().
+
+Use DefaultDotDict.peek() for reads which shouldn't add missing items.
+
+See main() for a demo, `python defaultdotdict.py benchmark` for a
+micro-benchmark of deep dotted reads.
 
 Master copy lives here:
 https://gist.github.com/tbnorth/61d3b75f26637d9f26c1678c5d94cb8e
@@ -12,6 +18,7 @@ https://gist.github.com/tbnorth/61d3b75f26637d9f26c1678c5d94cb8e
 Terry N. Brown, terrynbrown@gmail.com, Wed Mar 01 09:44:29 2017
 """
 
+import copy
 import json
 
 try:  # Python 2 / 3 compatible string testing
@@ -21,34 +28,213 @@ except NameError:
 
 class KeyNotAString(Exception): pass
 
+class ChangeTracker(object):
+    """record paths (tuples of keys) of items set or deleted in a tree of
+    DefaultDotDicts, see DefaultDotDict.track()"""
+    def __init__(self, root):
+        self.root = root
+        self.changed = set()
+        # mutable non-DefaultDotDict values that have been read, e.g.
+        # lists, path -> copy when first read, to see if they've been
+        # changed in place
+        self.touched = {}
+    def touch(self, path, value):
+        """note value at path was read, see touched"""
+        if path not in self.touched:
+            self.touched[path] = copy.deepcopy(value)
+    def paths(self, ignore=()):
+        """changed paths, and touched paths with changed values, without
+        paths inside other paths, and without paths starting with a path
+        in ignore"""
+        missing = object()
+        modified = set(
+            path for path, value in self.touched.items()
+            if DefaultDotDict.get_path(self.root, path, missing) != value
+        )
+        ans = []
+        seen = set(ignore)
+        for path in sorted(self.changed | modified, key=len):
+            if not any(path[:i] in seen for i in range(1, len(path) + 1)):
+                ans.append(path)
+                seen.add(path)
+        return ans
+    def reset(self):
+        self.changed.clear()
+        self.touched.clear()
+
+# attributes, not keys, of DefaultDotDicts
+INTERNAL = set(['_string_keys', '_tracker', '_path'])
+# values safe to compare, to ignore setting an unchanged value
+SIMPLE = (basestring, int, float, bool, type(None))
+PY2 = str is bytes  # Python 2 strs are decoded on access
+_getitem = dict.__getitem__
+_getattribute = object.__getattribute__
+# types of values which may be changed in place, see ChangeTracker.touched
+MUTABLE = (list, dict)
+
 class DefaultDotDict(dict):
     """Allow a.x as well as a['x'] for dicts"""
+    __slots__ = tuple(INTERNAL)
     def __init__(self, string_keys=False, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
         self._string_keys = string_keys
-    def __getattr__(self, item):
-        # return the item or an empty DefaultDotDict
-        if self._string_keys and not isinstance(item, basestring):
-            raise KeyNotAString(str(item))
-        if item not in self:
-            self[item] = DefaultDotDict(string_keys=self._string_keys)
-        return self[item].decode('utf-8') if isinstance(self[item], str) else self[item]
+        self._tracker = None
+        self._path = ()
+    def __getattribute__(self, item):
+        # return the item or an empty DefaultDotDict, one dict lookup
+        # when the item exists - overriding __getattribute__ rather than
+        # __getattr__ avoids a failed attribute lookup per access
+        if item in ATTRIBUTES:  # methods etc. take precedence over items
+            return _getattribute(self, item)
+        try:
+            value = _getitem(self, item)
+        except KeyError:
+            if item in HELPERS:  # items take precedence over these
+                return _getattribute(self, item)
+            if item[:2] == '__':  # e.g. copy / pickle probing
+                return _getattribute(self, item)
+            try:  # e.g. attributes of subclasses
+                return _getattribute(self, item)
+            except AttributeError:
+                return self._missing(item)
+        if (type(value) in MUTABLE
+                and _getattribute(self, '_tracker') is not None):
+            self._tracker.touch(self._path + (item,), value)
+        if PY2 and isinstance(value, str):
+            return value.decode('utf-8')
+        return value
     def __getitem__(self, item):
         # return the item or an empty DefaultDotDict
+        try:
+            value = _getitem(self, item)
+        except KeyError:
+            return self._missing(item)
+        if (type(value) in MUTABLE
+                and _getattribute(self, '_tracker') is not None):
+            self._tracker.touch(self._path + (item,), value)
+        if PY2 and isinstance(value, str):
+            return value.decode('utf-8')
+        return value
+    def _missing(self, item):
+        # add and return an empty DefaultDotDict for a missing item, not
+        # a change, see track(), until something's set in it
         if self._string_keys and not isinstance(item, basestring):
             raise KeyNotAString(str(item))
-        if item not in self:
-            self[item] = DefaultDotDict(string_keys=self._string_keys)
-        item = super(DefaultDotDict, self).__getitem__(item)
-        return item.decode('utf-8') if isinstance(item, str) else item
+        value = DefaultDotDict(string_keys=self._string_keys)
+        dict.__setitem__(self, item, value)
+        if self._tracker is not None:
+            DefaultDotDict.track(value, self._tracker, self._path + (item,))
+        return value
+
+    def peek(self, item):
+        """read only self[item], an empty DefaultDotDict not added to self
+        if it's missing, and not tracked, see ChangeTracker.touched, for
+        reads which won't change anything, e.g. from templates"""
+        try:
+            value = _getitem(self, item)
+        except KeyError:
+            return DefaultDotDict(string_keys=self._string_keys)
+        if PY2 and isinstance(value, str):
+            return value.decode('utf-8')
+        return value
+
+    def __reduce__(self):
+        # for pickle / copy, __slots__ need explicit support
+        return (
+            DefaultDotDict, (self._string_keys,), None, None,
+            iter(dict.items(self))
+        )
 
     def __setattr__(self, key, value):
-        if key == '_string_keys':
+        if key in INTERNAL:
             return dict.__setattr__(self, key, value)
         if self._string_keys and not isinstance(key, basestring):
             raise KeyNotAString(str(key))
         self[key] = value
 
+    def __setitem__(self, key, value):
+        if (self._tracker is not None and isinstance(value, SIMPLE)
+                and key in self):
+            old = dict.__getitem__(self, key)
+            if type(old) is type(value) and old == value:
+                return  # no change
+        dict.__setitem__(self, key, value)
+        if self._tracker is not None:
+            path = self._path + (key,)
+            if isinstance(value, DefaultDotDict):
+                DefaultDotDict.track(value, self._tracker, path)
+            self._tracker.changed.add(path)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if self._tracker is not None:
+            self._tracker.changed.add(self._path + (key,))
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *args):
+        if key in self and self._tracker is not None:
+            self._tracker.changed.add(self._path + (key,))
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if self._tracker is not None:
+            self._tracker.changed.add(self._path + (key,))
+        return key, value
+
+    def clear(self):
+        if self._tracker is not None:
+            self._tracker.changed.update(self._path + (i,) for i in self)
+        dict.clear(self)
+
+    def track(self, tracker=None, path=()):
+        """start tracking changes to this and contained DefaultDotDicts,
+        returns the ChangeTracker
+
+        Setting or deleting items are changes, as are changes in place to
+        lists etc. that have been read, but reading missing items, which
+        adds empty DefaultDotDicts, isn't.
+
+        Items named like this and the other methods in HELPERS hide them,
+        so code handling arbitrary DefaultDotDicts should call them via
+        the class, DefaultDotDict.track(obj)."""
+        self._tracker = tracker or ChangeTracker(self)
+        self._path = path
+        for key, value in self.items():
+            if isinstance(value, DefaultDotDict):
+                DefaultDotDict.track(value, self._tracker, path + (key,))
+        return self._tracker
+
+    def get_path(self, path, default=None):
+        """item at path (tuple of keys), without adding missing items"""
+        value = self
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return default
+            value = dict.__getitem__(value, key)
+        return value
+
+    def set_path(self, path, value):
+        """set item at path (tuple of keys), adding missing items"""
+        target = self
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+
+    def del_path(self, path):
+        """delete item at path (tuple of keys), if present"""
+        target = DefaultDotDict.get_path(self, path[:-1])
+        if isinstance(target, dict) and path[-1] in target:
+            del target[path[-1]]
+
     @staticmethod
     def json_object_hook(dct):
         """for JSON's object_hook argument, convert dicts to DefaultDotDicts"""
@@ -61,6 +247,47 @@ class DefaultDotDict(dict):
         """used like json.load, but uses DefaultDotDict.json_object_hook"""
         return json.load(fileobj, object_hook=DefaultDotDict.json_object_hook)
 
+    def json_journal(self, fileobj, paths):
+        """append changes at paths (see ChangeTracker.paths()) to a JSON
+        lines journal, see json_replay()"""
+        missing = object()
+        for path in paths:
+            value = DefaultDotDict.get_path(self, path, missing)
+            if value is missing:
+                entry = {'del': list(path)}
+            else:
+                entry = {'set': list(path), 'value': value}
+            fileobj.write(json.dumps(entry, sort_keys=True))
+            fileobj.write('\n')
+
+    def json_replay(self, fileobj):
+        """apply changes from a json_journal() file, returns count"""
+        count = 0
+        for line in fileobj:
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(
+                    line, object_hook=DefaultDotDict.json_object_hook)
+            except ValueError:  # partial last line from a crash
+                break
+            if 'del' in entry:
+                DefaultDotDict.del_path(self, tuple(entry['del']))
+            else:
+                DefaultDotDict.set_path(
+                    self, tuple(entry['set']), entry['value'])
+            count += 1
+        return count
+
+# methods added since items were first reachable as attributes, items
+# with these names take precedence, so existing data isn't hidden
+HELPERS = frozenset([
+    'track', 'peek', 'get_path', 'set_path', 'del_path', 'json_journal',
+    'json_replay',
+])
+# names that are attributes, not items, of DefaultDotDicts
+ATTRIBUTES = frozenset(dir(DefaultDotDict)) - HELPERS
+
 def main():
     """simple test / demo of DefaultDotDict"""
     import os, pprint, tempfile
@@ -71,7 +298,7 @@ def main():
     # save to a tempory JSON file
     handle, filename = tempfile.mkstemp()
     os.close(handle)
-    json.dump(a, open(filename, 'wb'))
+    json.dump(a, open(filename, 'w'))
     new_a = DefaultDotDict.json_load(open(filename))
     os.unlink(filename)
 
@@ -87,7 +314,52 @@ def main():
     print(hasattr(new_a, 'test'))  # True
     print('test' in new_a)  # now it's True
 
+def benchmark(repeat=5, number=200000):
+    """time deep dotted reads, a.b.c.d.e, against the original
+    implementation, which looked up items three times per access"""
+    import timeit
+
+    class OldDotDict(dict):
+        def __getattr__(self, item):
+            if item not in self:
+                self[item] = OldDotDict()
+            return (self[item].decode('utf-8') if isinstance(self[item], bytes)
+                    else self[item])
+        def __getitem__(self, item):
+            if item not in self:
+                self[item] = OldDotDict()
+            item = dict.__getitem__(self, item)
+            return item.decode('utf-8') if isinstance(item, bytes) else item
+
+    tests = [
+        ("dict a['b']['c']['d']['e']", dict, lambda a: a['b']['c']['d']['e']),
+        ("original a.b.c.d.e", OldDotDict, lambda a: a.b.c.d.e),
+        ("DefaultDotDict a.b.c.d.e", DefaultDotDict, lambda a: a.b.c.d.e),
+        ("DefaultDotDict tracked", DefaultDotDict, lambda a: a.b.c.d.e),
+        ("DefaultDotDict a['b']['c']['d']['e']", DefaultDotDict,
+         lambda a: a['b']['c']['d']['e']),
+        ("DefaultDotDict peek()", DefaultDotDict,
+         lambda a: a.peek('b').peek('c').peek('d').peek('e')),
+    ]
+    times = {}
+    for name, class_, read in tests:
+        a = class_()
+        a['b'] = class_(); a['b']['c'] = class_(); a['b']['c']['d'] = class_()
+        a['b']['c']['d']['e'] = 42
+        if name.endswith('tracked'):
+            a.track()
+        assert read(a) == 42
+        time = min(timeit.Timer(lambda: read(a)).repeat(repeat, number))
+        times[name] = time
+        print("%-40s %.3f us/read" % (name, time / number * 1e6))
+    print("%.1fx faster than original" % (
+        times["original a.b.c.d.e"] / times["DefaultDotDict a.b.c.d.e"]))
+
 if __name__ == '__main__':
-    main()
+    import sys
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        main()
 
 
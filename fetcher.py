@@ -0,0 +1,267 @@
+"""
+fetcher.py - download remote data files with connection reuse, limited
+concurrency, resuming of partial downloads, ETag / Last-Modified
+revalidation, and checksum checks.
+
+Expected checksums can be given as a URL fragment, which is never sent to
+the server, e.g.
+
+    http://example.com/data.csv#sha1=2fd4e1c67a2d28fced849ee1bb76e7391b93eb12
+
+Typical usage:
+
+    fetcher = Fetcher('build/DATA/fetch.json')
+    fetcher.fetch_all([(url, 'build/DATA/x/data.csv'), ...])
+
+Terry N. Brown, terrynbrown@gmail.com
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore, Lock
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+    from urlparse import urlsplit
+
+BLOCK = 1 << 20  # bytes read / written at a time
+
+
+class ChecksumError(Exception):
+    pass
+
+
+class Fetcher(object):
+    """Fetcher - download URLs to files, remembering ETag / Last-Modified
+    headers and checksums in a JSON state file
+    """
+
+    def __init__(self, state_path, workers=4, per_host=2, timeout=60):
+        """
+        Args:
+            state_path (str): path to JSON state file
+            workers (int): max. concurrent downloads
+            per_host (int): max. concurrent downloads from one host
+            timeout (float): seconds to wait for a server response
+        """
+        import requests  # only needed if there are remote sources
+
+        self.state_path = state_path
+        self.timeout = timeout
+        self.per_host = per_host
+        self.workers = workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.slots = BoundedSemaphore(workers)
+        self.host_slots = {}
+        self.lock = Lock()
+        self.state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as in_:
+                self.state = json.load(in_)
+
+    def checked(self, target):
+        """checked - time target was last fetched or revalidated
+
+        :param str target: path to file
+        :return: time.time() of last check, 0 if never / file missing
+        :rtype: float
+        """
+        if not os.path.exists(target):
+            return 0
+        with self.lock:
+            return self.state.get(target, {}).get('checked', 0)
+
+    def fetch(self, url, target):
+        """fetch - download url to target if it's changed
+
+        :param str url: URL, optionally with #<hash algorithm>=<hex digest>
+        :param str target: path to file
+        :return: 'fetched', 'resumed', or 'not modified'
+        :rtype: str
+        """
+        url, _, fragment = url.partition('#')
+        expected = fragment.split('=', 1) if '=' in fragment else None
+        host = urlsplit(url).netloc
+        with self.lock:
+            info = dict(self.state.get(target, {}))
+            if host not in self.host_slots:
+                self.host_slots[host] = BoundedSemaphore(self.per_host)
+        if info.get('url') != url:
+            info = {'url': url}
+
+        with self.slots, self.host_slots[host]:
+            if url.lower().startswith('ftp:'):
+                result = self._fetch_ftp(url, target)
+            else:
+                result = self._fetch_http(url, target, info)
+
+        if result != 'not modified':
+            info['sha1'] = file_digest(target)
+            if expected:
+                algorithm, hexdigest = expected
+                digest = info['sha1']
+                if algorithm.lower() != 'sha1':
+                    digest = file_digest(target, algorithm)
+                if digest != hexdigest.lower():
+                    os.unlink(target)
+                    raise ChecksumError(
+                        "%s checksum for '%s' is %s not %s"
+                        % (algorithm, url, digest, hexdigest)
+                    )
+        info['checked'] = time.time()
+        with self.lock:
+            self.state[target] = info
+            self._save()
+        return result
+
+    def fetch_all(self, items):
+        """fetch_all - fetch (url, target) pairs concurrently
+
+        :param list items: (url, target) pairs
+        :return: fetch() result, or exception, for each pair
+        :rtype: list
+        """
+
+        def fetch(item):
+            try:
+                return self.fetch(*item)
+            except Exception as exc:
+                return exc
+
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(fetch, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _fetch_http(self, url, target, info):
+        """_fetch_http - fetch() for http / https, see fetch()"""
+        headers = {}
+        partial = target + '.part'
+        if os.path.exists(target):
+            if info.get('etag'):
+                headers['If-None-Match'] = info['etag']
+            if info.get('last_modified'):
+                headers['If-Modified-Since'] = info['last_modified']
+        elif os.path.exists(partial) and info.get('partial_of'):
+            # resume, If-Range gets a whole new file if it's changed
+            headers['Range'] = 'bytes=%d-' % os.path.getsize(partial)
+            headers['If-Range'] = info['partial_of']
+
+        response = self.session.get(
+            url, headers=headers, stream=True, timeout=self.timeout
+        )
+        if response.status_code == 416 and 'Range' in headers:
+            # .part file's no use, e.g. it's already complete or the file
+            # shrank without changing ETag, so start again
+            response.close()
+            os.unlink(partial)
+            del info['partial_of']
+            return self._fetch_http(url, target, info)
+        try:
+            if response.status_code == 304:
+                return 'not modified'
+            response.raise_for_status()
+            resumed = response.status_code == 206
+            info['etag'] = response.headers.get('ETag')
+            info['last_modified'] = response.headers.get('Last-Modified')
+            # remember which version the .part file is, for If-Range
+            info['partial_of'] = info['etag'] or info['last_modified']
+            with self.lock:
+                self.state[target] = dict(info)
+                self._save()
+            make_dir(os.path.dirname(target))
+            with open(partial, 'ab' if resumed else 'wb') as out:
+                for block in response.iter_content(BLOCK):
+                    out.write(block)
+        finally:
+            response.close()
+        replace(partial, target)
+        del info['partial_of']
+        return 'resumed' if resumed else 'fetched'
+
+    def _fetch_ftp(self, url, target):
+        """_fetch_ftp - fetch() for ftp, always downloads"""
+        partial = target + '.part'
+        make_dir(os.path.dirname(target))
+        source = urlopen(url, timeout=self.timeout)
+        try:
+            with open(partial, 'wb') as out:
+                shutil.copyfileobj(source, out, BLOCK)
+        finally:
+            source.close()
+        replace(partial, target)
+        return 'fetched'
+
+    def _save(self):
+        """_save - write state file, call with self.lock held"""
+        make_dir(os.path.dirname(self.state_path))
+        with open(self.state_path + '.tmp', 'w') as out:
+            json.dump(self.state, out, indent=2, sort_keys=True)
+        replace(self.state_path + '.tmp', self.state_path)
+
+
+def file_digest(path, algorithm='sha1'):
+    """file_digest - hash of a file's content, read in blocks
+
+    :param str path: path to file
+    :param str algorithm: hashlib algorithm name
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as in_:
+        for block in iter(lambda: in_.read(BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_dir(path):
+    """make_dir - make dirs recursively if not already present
+
+    :param str path: path to dir
+    """
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:  # another thread may have just made it
+            if not os.path.isdir(path):
+                raise
+
+
+def replace(source, target):
+    """replace - rename source to target, replacing target
+
+    :param str source: path to rename
+    :param str target: new path
+    """
+    if os.path.exists(target) and sys.platform == 'win32':
+        os.unlink(target)
+    os.rename(source, target)
+
+
+def main():
+    """fetch URLs given on the command line into the current directory"""
+    fetcher = Fetcher('.fetch.json')
+    items = [(url, url.split('#')[0].split('/')[-1]) for url in sys.argv[1:]]
+    for (url, target), result in zip(items, fetcher.fetch_all(items)):
+        print("%s: %s" % (target, result))
+
+
+if __name__ == '__main__':
+    main()
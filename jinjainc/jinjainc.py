@@ -4,14 +4,27 @@ jinjainc.py - Incremental evaluation in a Jinja2 template.
 Terry N. Brown, terrynbrown@gmail.com, Fri Jul 13 11:30:02 2018
 """
 
+import ast
+import hashlib
+import os
+import pickle
+import sys
+import time
+import types
+
+from collections import OrderedDict
+
 from jinja2 import Environment, DictLoader
 
 class IncerBlock:
-    """simple container for Incer call count / code block"""
-    def __init__(self, count):
-        """setup empty block with preceeding call count"""
-        self.count = count
+    """simple container for Incer code block"""
+    def __init__(self, start):
+        """setup empty block starting at template line `start`"""
+        self.start = start
+        self.end = None  # template line of closing ```
         self.lines = []
+        self.key = None  # hash of this and preceeding blocks' code
+        self.defs = None  # source of functions / classes defined so far
 
 class Incer:
     """
@@ -21,6 +34,26 @@ class Incer:
     the value of {{ _.a }} will depend on where in the template the
     expression occurs, updated as appropriate by code blocks.
 
+    Where an expression occurs is the template line being rendered when
+    it's evaluated, found from the render's stack frames, so loops,
+    conditionals, and macros work, a macro's lookups happening where
+    it's called.  Blocks are run lazily, when a lookup after them needs
+    them, so blocks after the last lookup never run.  Lookups from
+    outside a render see the state after all blocks.
+
+    With Incer(template_text, cache_dir='build/tmp/incer') the namespace
+    after each block is pickled in cache_dir, keyed by a hash of the code
+    of that block and all blocks before it, so re-rendering resumes after
+    the last unchanged block instead of re-running everything.  Modules
+    in the namespace are re-imported, and functions or classes defined in
+    the blocks which can't be pickled are re-defined from their source.
+    If any other value can't be pickled there's no snapshot for that
+    block, with a warning, so resuming never runs with values missing.
+    Only code is hashed, so a block reading files should list them in a
+    `# depends: path/to/data.csv ...` comment, making their content part
+    of the key.  Snapshots not used by this template are deleted when
+    they're more than max_age seconds old.
+
     ---cut here---
 
     `a` is {{ _.a }}, twice {{ _.a }}, thrice {{ _.a }}.
@@ -38,30 +71,171 @@ class Incer:
     ```
     Finally a: {{ _.a }} ({{ _.a }}).
     """
-    def __init__(self, template_text):
+    def __init__(self, template_text, cache_dir=None, max_age=7 * 86400):
         self.__globals = {}
-        self.__blocks = [IncerBlock(0)]
-        self.__n = 0
-
-        in_block = False
-        for line in template_text.split('\n'):
-            if line.startswith('```python'):
-                in_block = True
-            elif line.startswith('```') and in_block:
-                in_block = False
-                self.__blocks.append(IncerBlock(self.__blocks[-1].count))
-            elif in_block:
-                self.__blocks[-1].lines.append(line)
-            else:
-                self.__blocks[-1].count += line.count(' _.')
+        self.__blocks = []
+        self.__cache_dir = cache_dir
+        self.__warned = set()  # names warned about, see __save()
+
+        block = None
+        for line_n, line in enumerate(template_text.split('\n'), 1):
+            if line.startswith('```python') and block is None:
+                block = IncerBlock(line_n)
+            elif line.startswith('```') and block is not None:
+                block.end = line_n
+                self.__blocks.append(block)
+                block = None
+            elif block is not None:
+                block.lines.append(line)
+
+        key = hashlib.sha1()
+        defs = OrderedDict()
+        for block in self.__blocks:
+            key.update('\n'.join(block.lines).encode('utf-8'))
+            key.update(b'\0')  # so moving lines between blocks matters
+            for line in block.lines:
+                if line.strip().startswith('# depends:'):
+                    for path in line.split(':', 1)[1].split():
+                        key.update(file_hash(path).encode('utf-8'))
+            block.key = key.hexdigest()
+            for name, source in definitions(block.lines):
+                defs.pop(name, None)  # keep definition order
+                defs[name] = source
+            block.defs = OrderedDict(defs)
+
+        if cache_dir and os.path.isdir(cache_dir):
+            self.__prune(max_age)
 
     def __getattr__(self, attr_name):
-        self.__n += 1
-        while self.__blocks and self.__n > self.__blocks[0].count:
-            exec('\n'.join(self.__blocks[0].lines), self.__globals)
-            del self.__blocks[0]
+        line_n = self.__render_line()
+        cached = None  # key of the last cached block passed over
+        while self.__blocks and (
+            line_n is None or line_n > self.__blocks[0].end
+        ):
+            block = self.__blocks.pop(0)
+            if self.__cached(block.key):
+                cached = block.key  # load only the last one needed
+                continue
+            if cached:
+                self.__load(cached)
+                cached = None
+            exec('\n'.join(block.lines), self.__globals)
+            self.__save(block)
+        if cached:
+            self.__load(cached)
         return str(self.__globals.get(attr_name, '???'))
 
+    @staticmethod
+    def __render_line():
+        """template line being rendered by the outermost template on the
+        stack, None if not called from a template"""
+        line_n = None
+        frame = sys._getframe(1)
+        while frame is not None:
+            template = frame.f_globals.get('__jinja_template__')
+            if template is not None:
+                line_n = template.get_corresponding_lineno(frame.f_lineno)
+            frame = frame.f_back
+        return line_n
+
+    def __path(self, key):
+        return os.path.join(self.__cache_dir, key + '.pickle')
+
+    def __cached(self, key):
+        """True if there's a snapshot of the namespace for key"""
+        return bool(self.__cache_dir) and os.path.exists(self.__path(key))
+
+    def __load(self, key):
+        """replace the namespace with the snapshot for key"""
+        path = self.__path(key)
+        with open(path, 'rb') as in_:
+            values, modules, sources = pickle.load(in_)
+        os.utime(path, None)  # recently used, see __prune()
+        self.__globals.clear()
+        for name, module in modules.items():
+            __import__(module)
+            values[name] = sys.modules[module]
+        self.__globals.update(values)
+        for name, source in sources:
+            exec(source, self.__globals)
+
+    def __save(self, block):
+        """save a snapshot of the namespace after block, unless it has
+        values which can't be pickled or re-defined from source"""
+        if not self.__cache_dir:
+            return
+        values, modules, sources = {}, {}, []
+        for name, value in self.__globals.items():
+            if name == '__builtins__':
+                continue
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+                continue
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                if name in block.defs and isinstance(
+                    value, (types.FunctionType, type)
+                ):
+                    continue  # re-defined from source, see below
+                if name not in self.__warned:
+                    self.__warned.add(name)
+                    sys.stderr.write(
+                        "WARNING: Incer can't pickle '%s', blocks won't "
+                        "be cached while it's defined\n" % name
+                    )
+                return  # a partial snapshot would resume differently
+            values[name] = value
+        for name, source in block.defs.items():
+            if name in self.__globals and name not in values:
+                sources.append((name, source))
+        data = pickle.dumps(
+            (values, modules, sources), pickle.HIGHEST_PROTOCOL
+        )
+        if not os.path.isdir(self.__cache_dir):
+            os.makedirs(self.__cache_dir)
+        path = self.__path(block.key)
+        with open(path + '.tmp', 'wb') as out:
+            out.write(data)
+        if os.path.exists(path) and sys.platform == 'win32':
+            os.unlink(path)
+        os.rename(path + '.tmp', path)
+
+    def __prune(self, max_age):
+        """delete other templates' snapshots not used for max_age seconds"""
+        keep = set(os.path.basename(self.__path(i.key)) for i in self.__blocks)
+        for filename in os.listdir(self.__cache_dir):
+            path = os.path.join(self.__cache_dir, filename)
+            if (
+                filename.endswith('.pickle')
+                and filename not in keep
+                and os.path.getmtime(path) < time.time() - max_age
+            ):
+                os.unlink(path)
+
+def file_hash(path):
+    """sha1 of a file's content, for `# depends:` in Incer blocks"""
+    if not os.path.exists(path):
+        return 'missing'
+    with open(path, 'rb') as in_:
+        return hashlib.sha1(in_.read()).hexdigest()
+
+def definitions(lines):
+    """(name, source) for top level functions and classes in code lines"""
+    try:
+        body = ast.parse('\n'.join(lines)).body
+    except SyntaxError:  # reported when the block's run
+        return []
+    ans = []
+    for n, node in enumerate(body):
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            start = min(
+                [node.lineno] + [i.lineno for i in node.decorator_list]
+            )
+            end = body[n + 1].lineno - 1 if n + 1 < len(body) else len(lines)
+            ans.append((node.name, '\n'.join(lines[start - 1:end])))
+    return ans
+
 def main():
 
     import re  # cut the example out of the doc string.
@@ -0,0 +1,443 @@
+"""
+pandocast.py - parse markdown to pandoc's JSON AST once, number figures,
+equations, and tables in-process, and cache the result, so each output
+format only needs pandoc's writer step.
+
+Numbering replaces the pandoc-fignos, pandoc-eqnos, and pandoc-tablenos
+filters for their basic syntax:
+
+    ![Caption](path/to/image.png){#fig:label}
+    $$ x = y^2 $$ {#eq:label}
+    Table: Caption {#tbl:label}
+
+    See Figure&nbsp;@fig:label, eq. @eq:label, and [@tbl:label].
+
+References become the number of the thing referenced, captions are
+prefixed with "Figure N:" / "Table N:", and equations get "(N)".  For
+LaTeX, \\label and \\ref are used instead, so LaTeX does the numbering.
+Handles the AST from pandoc 2 (implicit figures as a lone image in a
+paragraph) and pandoc 3 (Figure blocks, attributes on tables).
+
+Can also be used as a pandoc JSON filter:
+
+    pandoc --filter pandocast.py ...
+
+Terry N. Brown, terrynbrown@gmail.com
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+from subprocess import Popen, PIPE
+
+# labels, e.g. fig:label, handled, and their caption names
+KINDS = {'fig': 'Figure', 'eq': 'Equation', 'tbl': 'Table'}
+NBSP = u'\xa0'
+# pandoc options to resolve citations, None to pick by pandoc version,
+# see citeproc_args()
+CITEPROC = None
+MAX_AGE = 7 * 24 * 60 * 60  # seconds cached ASTs are kept unused
+PANDOC_VERSION = []  # see pandoc_version()
+
+
+class PandocError(Exception):
+    pass
+
+
+class XrefNumberer(object):
+    """XrefNumberer - number figures, equations, and tables, and replace
+    references to them, in one pass over a pandoc JSON AST
+    """
+
+    def __init__(self, latex=False):
+        """
+        Args:
+            latex (bool): use \\label / \\ref, let LaTeX number things
+        """
+        self.latex = latex
+        self.numbers = {}  # label -> number
+        self.counts = dict((i, 0) for i in KINDS)
+        self.refs = []  # (list, index) of Cite elements, see walk()
+        self.missing = set()  # referenced labels not found
+
+    def number(self, doc):
+        """number - number things and replace references in doc
+
+        :param dict doc: pandoc JSON AST, modified in place
+        :return: doc
+        :rtype: dict
+        """
+        self.walk(doc['blocks'])
+        # references can precede the thing referenced, so replace them
+        # after the walk, without walking the AST again
+        for parent, index in self.refs:
+            parent[index] = self.reference(parent[index])
+        return doc
+
+    def walk(self, value):
+        """walk - visit value and its children, numbering things, and
+        recording the location of references
+
+        :param value: part of a pandoc JSON AST
+        """
+        if isinstance(value, list):
+            out = []
+            i = 0
+            while i < len(value):
+                item = value[i]
+                i += 1
+                if is_display_math(item):
+                    label, used = attr_after(value, i)
+                    if kind_of(label) == 'eq':
+                        item = self.equation(item, label)
+                        i += used
+                elif is_elem(item, 'Cite') and all(
+                    kind_of(c['citationId']) for c in item['c'][0]
+                ):
+                    self.refs.append((value, len(out)))
+                else:
+                    self.walk(item)
+                out.append(item)
+            value[:] = out
+        elif isinstance(value, dict):
+            type_ = value.get('t')
+            if type_ == 'Figure':
+                self.figure(value)
+            elif type_ in ('Para', 'Plain'):
+                self.implicit_figure(value)
+            elif type_ == 'Table':
+                self.table(value)
+            if 'c' in value:
+                self.walk(value['c'])
+
+    def caption_prefix(self, kind, label):
+        """caption_prefix - number label, return inlines to start its
+        caption with
+
+        :param str kind: 'fig', 'eq', or 'tbl'
+        :param str label: e.g. 'fig:label'
+        :return: list of inlines
+        :rtype: list
+        """
+        self.counts[kind] += 1
+        self.numbers[label] = self.counts[kind]
+        if self.latex:
+            return []
+        return [
+            elem('Str', u"%s%s%d:" % (KINDS[kind], NBSP, self.counts[kind])),
+            elem('Space'),
+        ]
+
+    def figure(self, value):
+        """figure - number a pandoc 3 Figure block"""
+        label = value['c'][0][0]
+        if kind_of(label) == 'fig':
+            caption_inlines(value['c'][1])[:0] = self.caption_prefix(
+                'fig', label
+            )
+
+    def implicit_figure(self, value):
+        """implicit_figure - number a pandoc 2 figure, an image with
+        title 'fig:' alone in a paragraph"""
+        inlines = value['c']
+        if len(inlines) != 1 or not is_elem(inlines[0], 'Image'):
+            return
+        attr, caption, target = inlines[0]['c']
+        if not target[1].startswith('fig:') or kind_of(attr[0]) != 'fig':
+            return
+        caption[:0] = self.caption_prefix('fig', attr[0])
+        if self.latex:
+            caption.append(label_inline(attr[0]))
+
+    def table(self, value):
+        """table - number a table, label from its attributes (pandoc 3)
+        or the end of its caption (pandoc 2)"""
+        first = value['c'][0]
+        if first and not isinstance(first[0], dict):  # [id, classes, kv]
+            attr, caption = first, caption_inlines(value['c'][1])
+        else:  # pandoc < 2.10, no attributes, caption is inlines
+            attr, caption = None, value['c'][0]
+        label = attr[0] if attr else ''
+        if kind_of(label) != 'tbl':
+            label = ''
+            for i in range(len(caption)):
+                found, used = attr_after(caption, i)
+                if kind_of(found) == 'tbl' and i + used == len(caption):
+                    label = found
+                    del caption[i:]
+                    while caption and is_elem(caption[-1], 'Space'):
+                        caption.pop()
+                    break
+            if not label:
+                return
+            if attr:
+                attr[0] = label
+            elif self.latex:
+                caption.append(label_inline(label))
+        caption[:0] = self.caption_prefix('tbl', label)
+
+    def equation(self, value, label):
+        """equation - number a display math equation
+
+        :param dict value: Math element
+        :param str label: e.g. 'eq:label'
+        :return: replacement element
+        :rtype: dict
+        """
+        self.caption_prefix('eq', label)
+        math = value['c'][1]
+        if self.latex:
+            return elem(
+                'RawInline',
+                [
+                    'tex',
+                    "\\begin{equation}%s\\label{%s}\\end{equation}"
+                    % (math, label),
+                ],
+            )
+        math = u"%s \\qquad (%d)" % (math, self.numbers[label])
+        return elem(
+            'Span',
+            [[label, [], []], [elem('Math', [value['c'][0], math])]],
+        )
+
+    def reference(self, value):
+        """reference - replacement for a Cite of labels
+
+        :param dict value: Cite element
+        :return: replacement element
+        :rtype: dict
+        """
+        labels = [i['citationId'] for i in value['c'][0]]
+        if self.latex:
+            return elem(
+                'RawInline',
+                ['tex', ', '.join("\\ref{%s}" % i for i in labels)],
+            )
+        numbers = []
+        for label in labels:
+            if label in self.numbers:
+                numbers.append(str(self.numbers[label]))
+            else:
+                self.missing.add(label)
+                numbers.append('??')
+        return elem('Str', ', '.join(numbers))
+
+
+def elem(type_, content=None):
+    """elem - make a pandoc AST element
+
+    :param str type_: element type, e.g. 'Str'
+    :param content: element content
+    :return: element
+    :rtype: dict
+    """
+    if content is None:
+        return {'t': type_}
+    return {'t': type_, 'c': content}
+
+
+def is_elem(value, type_):
+    """is_elem - True if value is a pandoc AST element of type type_"""
+    return isinstance(value, dict) and value.get('t') == type_
+
+
+def is_display_math(value):
+    """is_display_math - True if value is a display math element"""
+    return is_elem(value, 'Math') and value['c'][0]['t'] == 'DisplayMath'
+
+
+def kind_of(label):
+    """kind_of - 'fig', 'eq', 'tbl', or None for label 'fig:label' etc."""
+    kind = label.split(':', 1)[0] if ':' in (label or '') else None
+    return kind if kind in KINDS else None
+
+
+def attr_after(inlines, i):
+    """attr_after - find {#label} starting at inlines[i], after optional
+    space
+
+    :param list inlines: inline elements
+    :param int i: index to start at
+    :return: (label, number of elements used), ('', 0) if not found
+    :rtype: (str, int)
+    """
+    used = 0
+    if i < len(inlines) and is_elem(inlines[i], 'Space'):
+        used = 1
+    if i + used < len(inlines) and is_elem(inlines[i + used], 'Str'):
+        text = inlines[i + used]['c']
+        if text.startswith('{#') and text.endswith('}'):
+            return (text[2:-1].split() or [''])[0], used + 1
+    return '', 0
+
+
+def caption_inlines(caption):
+    """caption_inlines - inlines of a pandoc >= 2.10 [short, blocks]
+    caption, adding a Plain block if needed
+
+    :param list caption: caption
+    :return: inlines, to modify in place
+    :rtype: list
+    """
+    blocks = caption[1]
+    if not blocks or blocks[0].get('t') not in ('Plain', 'Para'):
+        blocks.insert(0, elem('Plain', []))
+    return blocks[0]['c']
+
+
+def label_inline(label):
+    """label_inline - LaTeX \\label{} for label"""
+    return elem('RawInline', ['tex', "\\label{%s}" % label])
+
+
+def run_pandoc(cmd, input_=None):
+    """run_pandoc - run pandoc, return its output
+
+    :param list cmd: command
+    :param bytes input_: data for pandoc's stdin
+    :return: stdout
+    :rtype: bytes
+    :raises PandocError: if pandoc fails
+    """
+    proc = Popen(cmd, stdin=PIPE if input_ else None, stdout=PIPE)
+    output = proc.communicate(input_)[0]
+    if proc.returncode != 0:
+        raise PandocError(
+            "%s failed with exit code %d" % (' '.join(cmd), proc.returncode)
+        )
+    return output
+
+
+def pandoc_version():
+    """pandoc_version - version of pandoc on the PATH, cached
+
+    :return: version, e.g. (3, 1, 2), () if unknown
+    :rtype: tuple
+    """
+    if not PANDOC_VERSION:
+        output = run_pandoc(['pandoc', '--version']).decode('utf-8')
+        match = re.match(r'pandoc(?:\.exe)? ([0-9.]+)', output)
+        version = match.group(1).strip('.').split('.') if match else []
+        PANDOC_VERSION.append(tuple(int(i) for i in version))
+    return PANDOC_VERSION[0]
+
+
+def citeproc_args():
+    """citeproc_args - pandoc options to resolve citations, --citeproc for
+    pandoc >= 2.11, otherwise the pandoc-citeproc filter, unless CITEPROC
+    is set
+
+    :rtype: list
+    """
+    if CITEPROC is not None:
+        return CITEPROC
+    if pandoc_version() >= (2, 11):
+        return ['--citeproc']
+    return ['--filter', 'pandoc-citeproc']
+
+
+def prune(cache_dir, max_age=MAX_AGE):
+    """prune - delete cached ASTs unused for max_age seconds
+
+    :param str cache_dir: folder for cached ASTs
+    :param float max_age: seconds
+    """
+    cutoff = time.time() - max_age
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:  # another thread may have just removed it
+            pass
+
+
+def cached_ast(
+    source_file,
+    reader_args,
+    metadata=(),
+    latex=False,
+    citeproc=True,
+    depends=(),
+    cache_dir='build/tmp/ast',
+):
+    """cached_ast - parse a markdown file to pandoc's JSON AST, number
+    things, and optionally resolve citations, unless an AST for the same
+    input is cached
+
+    :param str source_file: path to markdown file
+    :param list reader_args: pandoc options for reading, e.g. --from
+    :param list metadata: key=value metadata, e.g. bibliography=refs.bib
+    :param bool latex: number things for LaTeX, see XrefNumberer
+    :param bool citeproc: resolve citations, after numbering, see
+        citeproc_args()
+    :param list depends: other files affecting the result, e.g. .bib
+    :param str cache_dir: folder for cached ASTs
+    :return: path to JSON AST file, for `pandoc --from json`
+    :rtype: str
+    """
+    key = hashlib.sha1()
+    with open(source_file, 'rb') as in_:
+        key.update(in_.read())
+    citeproc = citeproc and citeproc_args()
+    key.update(repr((reader_args, metadata, latex, citeproc)).encode())
+    for path in depends:
+        if os.path.exists(path):
+            with open(path, 'rb') as in_:
+                key.update(hashlib.sha1(in_.read()).hexdigest().encode())
+    ast_file = os.path.join(cache_dir, key.hexdigest() + '.json')
+    if os.path.exists(ast_file):
+        os.utime(ast_file, None)  # recently used, see prune()
+        return ast_file
+
+    metadata = sum((['--metadata', i] for i in metadata), [])
+    output = run_pandoc(
+        ['pandoc'] + reader_args + metadata + ['--to', 'json', source_file]
+    )
+    doc = json.loads(output.decode('utf-8'))
+    numberer = XrefNumberer(latex=latex)
+    numberer.number(doc)
+    for label in sorted(numberer.missing):
+        sys.stderr.write("WARNING: no target for reference '%s'\n" % label)
+    output = json.dumps(doc).encode('utf-8')
+    if citeproc:  # after numbering, or it sees @fig:x etc. as citations
+        output = run_pandoc(
+            ['pandoc', '--from', 'json', '--to', 'json'] + metadata + citeproc,
+            output,
+        )
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:  # another thread may have just made it
+            if not os.path.isdir(cache_dir):
+                raise
+    prune(cache_dir)
+    # unique temporary file, several formats may make the same AST at once
+    handle, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as out:
+        out.write(output)
+    if os.path.exists(ast_file) and sys.platform == 'win32':
+        os.unlink(ast_file)
+    os.rename(tmp_file, ast_file)
+    return ast_file
+
+
+def main():
+    """run as a pandoc JSON filter, output format is the first argument"""
+    fmt = sys.argv[1] if len(sys.argv) > 1 else ''
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    doc = json.loads(stdin.read().decode('utf-8'))
+    XrefNumberer(latex=fmt in ('latex', 'beamer')).number(doc)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout.write(json.dumps(doc).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
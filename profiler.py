@@ -0,0 +1,307 @@
+"""
+profiler.py - opt-in build profiling, recording wall / CPU time, peak
+RSS, subprocess CPU time, and bytes read / written for spans of a build,
+e.g. doit tasks and make_fmt() phases.
+
+    profiler.enable()
+    with profiler.span('render', 'make_fmt:html'):
+        ...
+    profiler.PROFILER.save('build/profile.json')
+    print(profiler.PROFILER.summary())
+
+span() does nothing (quickly) when profiling isn't enabled.
+
+CPU time and bytes read / written are per thread (bytes only on Linux).
+Subprocess CPU time and peak RSS are per process, so with parallel tasks
+they include other tasks' processes / memory, use one worker for exact
+attribution.  Peak RSS is the process's high water mark at the end of
+the span.
+
+The .trace.json file saved with save() can be loaded in Chrome's
+chrome://tracing or https://ui.perfetto.dev
+
+Terry N. Brown, terrynbrown@gmail.com
+"""
+
+import json
+import os
+import sys
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, current_thread
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILER = None  # the active Profiler, see enable()
+
+# /proc file with I/O counts for the current thread, Linux >= 3.17
+THREAD_IO = '/proc/thread-self/io'
+
+
+def thread_cpu():
+    """thread_cpu - CPU seconds used by the current thread, None if unknown
+
+    :rtype: float
+    """
+    if hasattr(time, 'thread_time'):  # Python >= 3.7
+        return time.thread_time()
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+
+def thread_io():
+    """thread_io - bytes read and written by the current thread
+
+    :return: (read, written), (None, None) if unknown
+    :rtype: (int, int)
+    """
+    try:
+        with open(THREAD_IO) as in_:
+            counts = dict(line.split(':', 1) for line in in_ if ':' in line)
+        return int(counts['rchar']), int(counts['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def sample():
+    """sample - current values of the counters spans record differences in
+
+    :return: counters, values None if unknown
+    :rtype: dict
+    """
+    ans = dict(wall=time.time(), cpu=thread_cpu())
+    ans['read'], ans['written'] = thread_io()
+    ans['child_cpu'] = ans['rss'] = None
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ans['child_cpu'] = usage.ru_utime + usage.ru_stime
+        ans['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':  # KiB, except on macOS
+            ans['rss'] *= 1024
+    return ans
+
+
+def difference(before, after, key):
+    """difference - after[key] - before[key], None if either is None"""
+    if before[key] is None or after[key] is None:
+        return None
+    return after[key] - before[key]
+
+
+class Profiler(object):
+    """Profiler - collect timed spans from any thread"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.lock = Lock()
+        self.threads = {}  # thread ident -> small int, for traces
+
+    @contextmanager
+    def span(self, name, category='build'):
+        """span - context manager recording an event for its body
+
+        :param str name: e.g. task name
+        :param str category: e.g. 'task', 'make_fmt:html', 'pandoc'
+        """
+        before = sample()
+        try:
+            yield
+        finally:
+            after = sample()
+            thread = current_thread()
+            with self.lock:
+                if thread.ident not in self.threads:
+                    self.threads[thread.ident] = len(self.threads) + 1
+                self.events.append(
+                    {
+                        'name': name,
+                        'category': category,
+                        'thread': self.threads[thread.ident],
+                        'thread_name': thread.name,
+                        'start': before['wall'] - self.start,
+                        'wall': after['wall'] - before['wall'],
+                        'cpu': difference(before, after, 'cpu'),
+                        'child_cpu': difference(before, after, 'child_cpu'),
+                        'peak_rss': after['rss'],
+                        'read': difference(before, after, 'read'),
+                        'written': difference(before, after, 'written'),
+                    }
+                )
+
+    def save(self, path='build/profile.json'):
+        """save - write events to path, and a Chrome trace-event file to
+        path with .json replaced by .trace.json
+
+        :param str path: path for JSON file
+        :return: path of trace file
+        :rtype: str
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with self.lock:
+            events = sorted(self.events, key=lambda x: x['start'])
+        with open(path, 'w') as out:
+            json.dump(
+                {'start': self.start, 'events': events},
+                out,
+                indent=2,
+                sort_keys=True,
+            )
+        trace_path = os.path.splitext(path)[0] + '.trace.json'
+        with open(trace_path, 'w') as out:
+            json.dump(self.chrome_trace(events), out)
+        return trace_path
+
+    def chrome_trace(self, events=None):
+        """chrome_trace - events in Chrome's trace-event format
+
+        :param list events: events, default self.events
+        :return: trace, for json.dump()
+        :rtype: dict
+        """
+        events = self.events if events is None else events
+        trace = []
+        named = set()
+        for event in events:
+            if event['thread'] not in named:
+                named.add(event['thread'])
+                trace.append(
+                    {
+                        'name': 'thread_name',
+                        'ph': 'M',
+                        'pid': 1,
+                        'tid': event['thread'],
+                        'args': {'name': event['thread_name']},
+                    }
+                )
+            trace.append(
+                {
+                    'name': event['name'],
+                    'cat': event['category'],
+                    'ph': 'X',
+                    'ts': int(event['start'] * 1e6),
+                    'dur': int(event['wall'] * 1e6),
+                    'pid': 1,
+                    'tid': event['thread'],
+                    'args': dict(
+                        (k, v)
+                        for k, v in event.items()
+                        if k in ('cpu', 'child_cpu', 'peak_rss', 'read',
+                                 'written')
+                    ),
+                }
+            )
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def summary(self, top=10):
+        """summary - text table of the top spans by wall time, and totals
+        by category
+
+        Nested spans are counted in their parent's totals too, e.g. a
+        pandoc run in a make_fmt task.
+
+        :param int top: number of spans to list
+        :return: summary
+        :rtype: str
+        """
+        with self.lock:
+            events = list(self.events)
+        lines = [
+            "Top %d of %d spans by wall time:" % (min(top, len(events)),
+                                                  len(events)),
+            "%9s %9s %9s %9s %9s %9s  %s"
+            % ('wall', 'cpu', 'child cpu', 'peak RSS', 'read', 'written',
+               'category: name'),
+        ]
+        events.sort(key=lambda x: -x['wall'])
+        for event in events[:top]:
+            lines.append(
+                "%9s %9s %9s %9s %9s %9s  %s: %s"
+                % (
+                    seconds(event['wall']),
+                    seconds(event['cpu']),
+                    seconds(event['child_cpu']),
+                    size(event['peak_rss']),
+                    size(event['read']),
+                    size(event['written']),
+                    event['category'],
+                    event['name'],
+                )
+            )
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        for event in events:
+            total = totals[event['category'].split(':')[0]]
+            total[0] += 1
+            total[1] += event['wall']
+            total[2] += event['cpu'] or 0
+        lines.append("Totals by category:")
+        for category, (count, wall, cpu) in sorted(
+            totals.items(), key=lambda x: -x[1][1]
+        ):
+            lines.append(
+                "%9s %9s  %s (%d)"
+                % (seconds(wall), seconds(cpu), category, count)
+            )
+        return '\n'.join(lines)
+
+
+def seconds(value):
+    """seconds - format seconds for summary()"""
+    return '-' if value is None else "%.2fs" % value
+
+
+def size(value):
+    """size - format bytes for summary()"""
+    if value is None:
+        return '-'
+    for unit in 'B', 'KiB', 'MiB':
+        if abs(value) < 1024:
+            return "%d%s" % (value, unit)
+        value /= 1024.0
+    return "%.1fGiB" % value
+
+
+def enable():
+    """enable - start profiling, span()s are recorded from now on
+
+    :return: the active Profiler
+    :rtype: Profiler
+    """
+    global PROFILER
+    PROFILER = Profiler()
+    return PROFILER
+
+
+def disable():
+    """disable - stop profiling
+
+    :return: the Profiler that was active, or None
+    :rtype: Profiler
+    """
+    global PROFILER
+    profiler, PROFILER = PROFILER, None
+    return profiler
+
+
+@contextmanager
+def span(name, category='build'):
+    """span - Profiler.span() for the active Profiler, if any
+
+    :param str name: e.g. task name
+    :param str category: e.g. 'task', 'make_fmt:html', 'pandoc'
+    """
+    profiler = PROFILER
+    if profiler is None:
+        yield
+    else:
+        with profiler.span(name, category):
+            yield
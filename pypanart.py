@@ -4,25 +4,45 @@ ImportError: No module named _bsddb
 """
 
 import ast
+import atexit
 import csv
+import functools
+import hashlib
+import io
 import json
 import os
 import re
 import shutil
-from StringIO import StringIO
 import sys
 import tempfile
 import time
 import zipfile
 
 from glob import glob
-from subprocess import Popen, PIPE
+from multiprocessing import cpu_count
+from subprocess import Popen, PIPE, STDOUT
 
-from defaultdotdict import DefaultDotDict
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+from threading import Lock, local
+
+from defaultdotdict import ATTRIBUTES, DefaultDotDict
+from fetcher import Fetcher, file_digest
+from pandocast import cached_ast
+import profiler
 
 import jinja2
+from jinja2 import nodes
+
+try:  # Jinja 3
+    pass_context = jinja2.pass_context
+except AttributeError:
+    pass_context = jinja2.contextfilter
 
 from doit.doit_cmd import DoitMain
+from doit.action import PythonAction
 from doit.cmd_base import ModuleTaskLoader
 
 JINJA_COMMON = dict(
@@ -31,8 +51,55 @@ JINJA_COMMON = dict(
     undefined=jinja2.StrictUndefined,
 )
 
+# formats built by fmt:all, 'latex' excluded as it's tex for vanilla latex
+ALL_FORMATS = 'html', 'pdf', 'odt', 'docx', 'tex'
+
+FICLONE = 0x40049409  # Linux ioctl for copy on write clones
+
+# idle InkscapeShell instances by inkscape path, see inkscape_export()
+INKSCAPE_SHELLS = {}
+INKSCAPE_LOCK = Lock()
+
+# doit commands, for which run_task() doesn't add parallel options
+DOIT_COMMANDS = (
+    'auto clean dumpdb forget help ignore info list reset-dep run strace '
+    'tabcompletion'
+).split()
+
+LOG_LOCK = Lock()  # serialize output from parallel tasks, see log()
+USER_TASK_LOCK = Lock()  # see user_task() and run_task()
+
+PROFILE_PATH = 'build/profile.json'  # see run_task(profile=)
+
+WATCH_PATHS = ['parts', 'img', 'doc-setup']  # see watch()
+
+SYNC_LOCK = Lock()  # see sync_file()
+
+# shared jinja2.Environments, see get_env()
+JINJA_ENVS = {}
+JINJA_STRINGS = {}  # templates for get_string_template()
+JINJA_CACHE = 'build/tmp/jinja'
+JINJA_LOCK = Lock()
+
+# code_index() results, in memory and on disk
+CODE_INDEX = {}
+CODE_INDEX_PATH = 'build/tmp/code_index.json'
+CODE_INDEX_LOCK = Lock()
+
+# (exit code, seconds) of pandoc for each format made, see make_fmt()
+# and run_task()
+FMT_RESULTS = {}
+
+# git_info() results, in memory and on disk
+GIT_INFO = {}
+GIT_INFO_PATH = 'build/tmp/git_info.json'
+GIT_LOCK = Lock()
+
+TASK = local()  # TASK.name is the running one_task() task, per thread
+
 try:
     import numpy as np
+    import fastcsv
 except ImportError:
     np = None
 
@@ -41,11 +108,30 @@ try:  # stop pyflakes complaining
 except NameError:
     execfile = list
 
+try:  # for link_or_copy()
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:  # for FileWatcher, polls without it
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:  # Python 2 / 3 compatible string testing
+    basestring
+except NameError:
+    basestring = str
+
 
 class OldFileFromContext(Exception):
     pass
 
 
+class InkscapeShellError(Exception):
+    pass
+
+
 class ExecutionContext(object):
     """ExecutionContext - Change os.getcwd() and sys.argv temporarily
     """
@@ -87,6 +173,423 @@ class ExecutionContext(object):
         return True
 
 
+class InkscapeShell(object):
+    """InkscapeShell - a long running `inkscape --shell` process, so
+    exporting many images only pays Inkscape's start up time once
+    """
+
+    def __init__(self, inkscape='inkscape'):
+        """
+        Args:
+            inkscape (str): path to inkscape executable
+        """
+        self.inkscape = inkscape
+        self.proc = None
+
+    def start(self):
+        """start - start the inkscape process and wait for its prompt"""
+        self.proc = Popen([self.inkscape, '--shell'], stdin=PIPE, stdout=PIPE)
+        self.read_prompt()
+
+    def read_prompt(self):
+        """read_prompt - read output up to inkscape's '>' prompt
+
+        Returns:
+            bytes: output preceding the prompt
+        Raises:
+            InkscapeShellError: if inkscape exits
+        """
+        buf = []
+        while True:
+            char = self.proc.stdout.read(1)
+            if not char:
+                raise InkscapeShellError("inkscape --shell exited")
+            if char == b'>' and (not buf or buf[-1] == b'\n'):
+                return b''.join(buf)
+            buf.append(char)
+
+    def export(self, svg, out, format):
+        """export - export an SVG file to PNG or PDF
+
+        Args:
+            svg (str): path to SVG file
+            out (str): path to output file
+            format (str): 'png' or 'pdf'
+        Returns:
+            bool: True if out was written
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        if os.path.exists(out):
+            os.unlink(out)
+        cmd = '"%s" --export-%s="%s" --export-area-page\n' % (
+            svg,
+            format,
+            out,
+        )
+        self.proc.stdin.write(cmd.encode('utf-8'))
+        self.proc.stdin.flush()
+        self.read_prompt()
+        return os.path.exists(out)
+
+    def close(self):
+        """close - ask inkscape to quit"""
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.write(b'quit\n')
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
+
+class LazyValue(object):
+    """LazyValue - value in C computed when first used, e.g. rendered
+    in a template, see resolve_lazy()
+    """
+
+    def __init__(self, func):
+        """
+        Args:
+            func (function): returns the value
+        """
+        self.func = func
+        self.done = False
+        self.value = None
+
+    def get(self):
+        """get - return the value, computing it if needed"""
+        if not self.done:
+            self.value = self.func()
+            self.done = True
+        return self.value
+
+    def __str__(self):
+        return str(self.get())
+
+    def __unicode__(self):
+        return u'%s' % self.get()
+
+    def __repr__(self):
+        return repr(self.get())
+
+    def __eq__(self, other):
+        return self.get() == other
+
+    def __ne__(self, other):
+        return self.get() != other
+
+    def __hash__(self):
+        return hash(self.get())
+
+    def __add__(self, other):
+        return self.get() + other
+
+    def __radd__(self, other):
+        return other + self.get()
+
+    def __len__(self):
+        return len(self.get())
+
+    def __getitem__(self, item):
+        return self.get()[item]
+
+    def __getattr__(self, item):
+        # e.g. C._metadata.title.upper(), but not copy / pickle probing,
+        # or this object's own attributes before __init__()
+        if item[:2] == '__' or item in ('func', 'done', 'value'):
+            raise AttributeError(item)
+        return getattr(self.get(), item)
+
+
+class LazyData(object):
+    """LazyData - stand in for a dataset in D, loaded on first use
+
+    Supports indexing, iteration, arithmetic, comparison, and numpy
+    functions, but isinstance() sees a LazyData, use .get() for the data
+    itself.
+    """
+
+    def __init__(self, name, load, on_access=None):
+        """
+        Args:
+            name (str): name of dataset
+            load (function): function returning the data
+            on_access (function): called with name on each access
+        """
+        self._name = name
+        self._load = load
+        self._on_access = on_access
+        self._data = None
+        self._lock = Lock()
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def get(self):
+        """get - return the data, loading it if needed"""
+        if self._on_access is not None:
+            self._on_access(self._name)
+        if self._data is None:
+            with self._lock:  # parallel tasks may want the same data
+                if self._data is None:
+                    self._data = self._load()
+        return self._data
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):  # e.g. copy / pickle probing
+            raise AttributeError(attr)
+        return getattr(self.get(), attr)
+
+    def __getitem__(self, item):
+        return self.get()[item]
+
+    def __setitem__(self, item, value):
+        self.get()[item] = value
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.get(), dtype=dtype, copy=True)
+        return np.asarray(self.get(), dtype=dtype)
+
+    def __repr__(self):
+        if self.loaded:
+            return repr(self._data)
+        return "<LazyData '%s' (not loaded)>" % self._name
+
+    __hash__ = object.__hash__  # defining __eq__ would remove it
+
+
+def lazy_method(name):
+    """lazy_method - LazyData method calling the data's method `name`"""
+
+    def method(self, *args):
+        return getattr(self.get(), name)(*args)
+
+    method.__name__ = name
+    return method
+
+
+for _name in (
+    'abs add and contains div eq floordiv ge gt invert le lshift lt '
+    'matmul mod mul ne neg or pos pow radd rand rdiv rfloordiv rlshift '
+    'rmatmul rmod rmul ror rpow rrshift rshift rsub rtruediv rxor sub '
+    'truediv xor'
+).split():
+    setattr(LazyData, '__%s__' % _name, lazy_method('__%s__' % _name))
+
+
+class ChunkedData(object):
+    """ChunkedData - stand in for a dataset in D that's too big to load
+    at once, iterating it gives numpy structured arrays of up to
+    `chunk_rows` rows, e.g.
+
+        total = sum(i['x'].sum() for i in D.big.select('x'))
+    """
+
+    def __init__(
+        self, name, path, on_access=None, columns=None, chunk_rows=None
+    ):
+        """
+        Args:
+            name (str): name of dataset
+            path (str): path to CSV file
+            on_access (function): called with name on each iteration
+            columns (list): names of columns to read, default all
+            chunk_rows (int): rows in each array
+        """
+        self.name = name
+        self.path = path
+        self.on_access = on_access
+        self.columns = columns
+        self.chunk_rows = chunk_rows or fastcsv.CHUNK_ROWS
+
+    def select(self, *columns):
+        """select - return a ChunkedData for only some columns
+
+        :param str columns: names of columns
+        :return: ChunkedData reading only those columns
+        :rtype: ChunkedData
+        """
+        return ChunkedData(
+            self.name,
+            self.path,
+            self.on_access,
+            list(columns),
+            self.chunk_rows,
+        )
+
+    def __iter__(self):
+        if self.on_access is not None:
+            self.on_access(self.name)
+        try:
+            scanned = fastcsv.scan_types(
+                self.path, self.columns, self.chunk_rows
+            )
+        except fastcsv.NotSimpleCSV as exc:
+            log("NOTE: %s, reading '%s' with genfromtxt" % (exc, self.path))
+            return self.iter_loaded()
+        return fastcsv.iter_csv(
+            self.path, self.columns, self.chunk_rows, scanned
+        )
+
+    def iter_loaded(self):
+        """iter_loaded - chunks of the whole file loaded with genfromtxt,
+        for files fastcsv can't handle"""
+        data = np.atleast_1d(genfromtxt_csv(self.path))
+        if self.columns:
+            data = data[list(self.columns)]
+        for start in range(0, len(data), self.chunk_rows):
+            yield data[start:start + self.chunk_rows]
+
+    def __repr__(self):
+        return "<ChunkedData '%s' %s>" % (self.name, self.columns or '')
+
+
+class FileWatcher(object):
+    """FileWatcher - wait for files under some paths to change
+
+    Changes are found by comparing the mtime and size of every file with
+    the previous scan, which takes milliseconds for a typical article's
+    parts/, img/, etc.  With inotify_simple installed (Linux), inotify
+    events wake the watcher, otherwise it polls every `interval` seconds.
+    """
+
+    def __init__(self, paths, interval=0.25, settle=0.1):
+        """
+        Args:
+            paths (list): files and folders (watched recursively)
+            interval (float): seconds between scans when polling
+            settle (float): seconds to wait for more changes, so an
+                editor's write / rename of a file is seen as one change
+        """
+        self.paths = paths
+        self.interval = interval
+        self.settle = settle
+        self.inotify = INotify() if INotify is not None else None
+        self.watched = set()  # folders with inotify watches
+        self.files = self.scan()
+
+    def scan(self):
+        """scan - current state of watched files
+
+        :return: {path: (mtime, size)}
+        :rtype: dict
+        """
+        files = {}
+        folders = []
+        for path in self.paths:
+            if os.path.isfile(path):
+                folders.append(os.path.dirname(path) or '.')
+                stat = os.stat(path)
+                files[os.path.normpath(path)] = stat.st_mtime, stat.st_size
+                continue
+            for folder, dirs, filenames in os.walk(path):
+                folders.append(folder)
+                for filename in filenames:
+                    filepath = os.path.normpath(os.path.join(folder, filename))
+                    try:
+                        stat = os.stat(filepath)
+                    except OSError:  # deleted since listed
+                        continue
+                    files[filepath] = stat.st_mtime, stat.st_size
+        if self.inotify is not None:
+            for folder in folders:  # including new ones
+                if folder not in self.watched:
+                    self.watched.add(folder)
+                    self.inotify.add_watch(
+                        folder,
+                        inotify_flags.CREATE
+                        | inotify_flags.DELETE
+                        | inotify_flags.MODIFY
+                        | inotify_flags.MOVED_FROM
+                        | inotify_flags.MOVED_TO
+                        | inotify_flags.CLOSE_WRITE,
+                    )
+        return files
+
+    def wait(self, timeout):
+        """wait - wait for an inotify event, or timeout seconds
+
+        :param float timeout: seconds
+        """
+        if self.inotify is None:
+            time.sleep(timeout)
+        else:
+            self.inotify.read(timeout=int(timeout * 1000))
+
+    def changes(self):
+        """changes - wait for files to change
+
+        :return: paths of changed, added, and deleted files
+        :rtype: list
+        """
+        changed = set()
+        while True:
+            self.wait(self.settle if changed else self.interval)
+            files = self.scan()
+            new = set(
+                path
+                for path in set(files) | set(self.files)
+                if files.get(path) != self.files.get(path)
+            )
+            self.files = files
+            if changed and not new:
+                return sorted(changed)
+            changed |= new
+
+
+class TaskLoader(ModuleTaskLoader):
+    """ModuleTaskLoader running user tasks, see user_task(), one at a
+    time, and optionally recording each task's execution with
+    profiler.span(), see run_task()
+    """
+
+    def __init__(self, mod_dict, profile=False, user_threads=False):
+        """
+        Args:
+            mod_dict (module or dict): tasks, see ModuleTaskLoader
+            profile (bool): record tasks with profiler.span()
+            user_threads (bool): let user tasks run in parallel too
+        """
+        ModuleTaskLoader.__init__(self, mod_dict)
+        self.profile = profile
+        self.user_threads = user_threads
+
+    def load_tasks(self, *args, **kwargs):
+        # returns (tasks, config) before doit 0.36, tasks after
+        result = ModuleTaskLoader.load_tasks(self, *args, **kwargs)
+        tasks = result[0] if isinstance(result, tuple) else result
+        for task in tasks:
+            if self.profile:
+                task.execute = profiled(task.execute, task.name, 'task')
+            if not self.user_threads and user_task(task):
+                task.execute = serialized(task.execute, USER_TASK_LOCK)
+        return result
+
+
+class PeekEnvironment(jinja2.Environment):
+    """jinja2.Environment for which template reads of missing items of
+    DefaultDotDicts, e.g. {{ C.x.y }}, don't add them to C, and reads of
+    lists etc. don't mark C as changed, see DefaultDotDict.peek()
+    """
+
+    def getattr(self, obj, attribute):
+        if isinstance(obj, DefaultDotDict) and attribute not in ATTRIBUTES:
+            return DefaultDotDict.peek(obj, attribute)
+        return jinja2.Environment.getattr(self, obj, attribute)
+
+    def getitem(self, obj, argument):
+        if isinstance(obj, DefaultDotDict):
+            return DefaultDotDict.peek(obj, argument)
+        return jinja2.Environment.getitem(self, obj, argument)
+
+
 class PyPanArtState(object):
     """PyPanArtState - Collect state for PyPanArt
     """
@@ -111,6 +614,8 @@ class PyPanArtState(object):
         config=None,
         setup=None,
         testing=False,
+        workers=None,
+        state_format='pretty',
     ):
         """basic inputs
 
@@ -124,15 +629,30 @@ class PyPanArtState(object):
             C and D, mostly for simple parameters
         :param list or string setup: list of task names to run first,
             before collect_data
+        :param int workers: number of parallel workers, defaults to
+            $PYPANART_JOBS or the number of CPUs
+        :param str state_format: how C is saved, 'pretty' (indented JSON),
+            'compact' (JSON without whitespace), or 'journal' (changes
+            appended to <statefile>.journal, which readers of the state
+            file must replay, see save_state())
         """
 
         self.basename = basename
         self.data_sources = data_sources
         self.data_dir = "build/DATA/"
+        self.manifest_path = os.path.join(self.data_dir, 'manifest.json')
+        self.manifest = None  # see read_manifest()
+        self.manifest_changed = False  # see save_manifest()
+        self.manifest_lock = Lock()
+        self.fetcher = None  # see get_fetcher()
+        self.revalidate = 24 * 60 * 60  # seconds, see fetched()
         self.parts = parts
         self.setup = self.as_list(setup)
         self.statefile = os.path.join('build', self.basename + '.state.json')
+        self.state_format = state_format
         self.testing = testing
+        self.workers = get_workers(workers)
+        self.data_access = {}  # dataset name -> tasks using it
         self.C, self.D = self._get_context_objects(
             self.statefile,
             config=self.as_list(config),
@@ -177,23 +697,43 @@ class PyPanArtState(object):
 
         if os.path.exists(state_file):
             C.update(DefaultDotDict.json_load(open(state_file)))
+        if os.path.exists(state_file + '.journal'):
+            with open(state_file + '.journal') as journal:
+                DefaultDotDict.json_replay(C, journal)
+        DefaultDotDict.track(C)  # record changes, see save_state()
 
         if not isinstance(config, (list, tuple)):
             config = [config]
         for conf in config:
             execfile(conf, {'C': C, 'D': D})
 
-        C._metadata.run.time = time.asctime()
-        proc = Popen('git rev-parse HEAD'.split(), stdout=PIPE)
-        commit, _ = proc.communicate()
-        proc = Popen('git diff-index HEAD --'.split(), stdout=PIPE)
-        mods, _ = proc.communicate()
-        mods = '+mods' if mods else ''
-        C._metadata.run.commit = commit.strip() + mods
-        C._metadata.run.commit_short = commit.strip()[:7] + mods
-        C._metadata.run.start_time = time.asctime()
         C._metadata.run.configs = config
         C._metadata._filepath = state_file
+        PyPanArtState._set_run_metadata(C, parts=parts, testing=testing)
+
+        # doit inspects things looking for .create_doit_tasks and
+        # fails when C and D return {}, so add dummy method, untracked
+        dict.__setitem__(C, 'create_doit_tasks', lambda: None)
+        D.create_doit_tasks = C.create_doit_tasks
+
+        return C, D
+
+    @staticmethod
+    def _set_run_metadata(C, parts=None, testing=False):
+        """Set C._metadata values describing this run, lazily where they
+        might be slow, see _get_context_objects() and new_run()
+
+        :param DefaultDotDict C: persistent state
+        :param list parts: article parts, the first has title etc.
+        :param bool testing: use fixed time / rev. info for testing
+        """
+        C._metadata.run.time = time.asctime()
+        # git can be slow, so only run it if the values are used
+        C._metadata.run.commit = LazyValue(lambda: git_info()['commit'])
+        C._metadata.run.commit_short = LazyValue(
+            lambda: git_info()['commit_short']
+        )
+        C._metadata.run.start_time = time.asctime()
         C._metadata.status = 'DRAFT'
 
         if testing:
@@ -202,35 +742,23 @@ class PyPanArtState(object):
             C._metadata.run.commit_short = "testing"
             C._metadata.status = 'TEST'
 
-        try:
-            if parts:
-                import yaml
-
-                with open(os.path.join('parts', parts[0] + '.md')) as f:
-                    dataMap = yaml.safe_load(f)
-                    C._metadata.title = dataMap['title']
-                    C._metadata.authors = ', '.join(
-                        i['name'] for i in dataMap['author']
-                    )
-                    corresponding = [
-                        i for i in dataMap['author'] if i.get('corresponding')
-                    ]
-                    fmt = "{c[email]} {c[name]} corresponding author"
-                    if corresponding:
-                        C._metadata.corresponding = fmt.format(
-                            c=corresponding[0]
-                        )
-                    else:
-                        C._metadata.corresponding = ""
-        except Exception:
-            print("Parsing part 0 as YAML failed")
-
-        # doit inspects things looking for .create_doit_tasks and
-        # fails when C and D return {}, so add dummy method
-        C.create_doit_tasks = lambda: None
-        D.create_doit_tasks = C.create_doit_tasks
+        if parts:
+            # parsed only if used, see part_metadata()
+            part = LazyValue(
+                lambda: part_metadata(os.path.join('parts', parts[0] + '.md'))
+            )
+            for key in 'title', 'authors', 'corresponding':
+                C._metadata[key] = LazyValue(
+                    lambda key=key: part.get().get(key, '')
+                )
 
-        return C, D
+    def new_run(self):
+        """new_run - refresh run time, git commit, title etc. in
+        C._metadata, for another build in the same process, see watch()
+        """
+        with GIT_LOCK:
+            GIT_INFO.clear()
+        self._set_run_metadata(self.C, parts=self.parts, testing=self.testing)
 
     def data_path(self, name, item=None):
         """data_path - return local path for data named in DATA_SOURCES
@@ -247,11 +775,29 @@ class PyPanArtState(object):
                 basename = self.data_sources[name][0]
             else:
                 basename = self.data_sources[name]
+            basename = basename.split(':TYPE:')[0]
+            if '://' in basename:  # drop #sha1=... etc., see fetcher.py
+                basename = basename.split('#')[0]
             # can't use os.path.basename, first path might be for
             # different OS
             basename = basename.replace('\\', '/').split('/')[-1]
             return os.path.join(self.data_dir, name, basename)
 
+    def data_type(self, name):
+        """data_type - return the type of data named in DATA_SOURCES
+
+        Types are given by appending e.g. ':TYPE:chunked' to the (first)
+        source path.
+
+        :param str name: name of data
+        :return: type, or None if not given
+        :rtype: str
+        """
+        source = self.as_list(self.data_sources[name])[0]
+        if ':TYPE:' in source:
+            return source.split(':TYPE:', 1)[1]
+        return None
+
     def get_C_D(self):
         """get_C_D - get persistent and runtime shared state containers
         """
@@ -292,11 +838,8 @@ class PyPanArtState(object):
             str: path to output file
         """
 
-        template_dict = {'tmplt': open(in_file).read().decode('utf-8')}
-        env = jinja2.Environment(
-            loader=jinja2.DictLoader(template_dict), **JINJA_COMMON
-        )
-        template = env.get_template('tmplt')
+        with io.open(in_file, encoding='utf-8') as in_:
+            template = get_string_template(in_.read())
         if out_file is None:
             # suffix required to stop pandoc adding one
             fd, out_file = tempfile.mkstemp(suffix='.template')
@@ -358,14 +901,15 @@ class PyPanArtState(object):
                     'ftp',
                 ):
                     # SINGLE FILE remote targets
-                    target = os.path.join(sub_path, sources.split('/')[-1])
-                    action = 'curl -o "%s" %s' % (target, sources)
-                    if not os.path.exists(target):
-                        yield {
-                            'name': 'curl ' + target,
-                            'targets': [target],
-                            'actions': [(make_dir, (sub_path,)), action],
-                        }
+                    target = os.path.join(
+                        sub_path, sources.split('#')[0].split('/')[-1]
+                    )
+                    yield {
+                        'name': 'fetch ' + target,
+                        'targets': [target],
+                        'uptodate': [(self.fetched, (target,))],
+                        'actions': [(self.fetch, (sources, target))],
+                    }
                 else:
                     sources = glob(os.path.splitext(sources)[0] + '*')
                     targets = [
@@ -375,50 +919,178 @@ class PyPanArtState(object):
                     for source, target in zip(sources, targets):
                         task = {
                             'name': name + target,
-                            'file_dep': [source],
+                            'uptodate': [(self.collected, (source, target))],
                             'targets': [target],
                             'actions': [
                                 (make_dir, (sub_path,)),
-                                (shutil.copy, (source, target)),
+                                (self.collect_file, (source, target)),
                             ],
+                            # once per run, not per file, see collect_file()
+                            'teardown': [self.save_manifest],
                             'task_dep': self.setup,
                         }
                         yield task
 
-    def make_data_loader(self):
-        """load_data - load global data for other tasks"""
+    def get_fetcher(self):
+        """get_fetcher - return the Fetcher for remote data sources"""
+        with self.manifest_lock:
+            if self.fetcher is None:
+                self.fetcher = Fetcher(
+                    os.path.join(self.data_dir, 'fetch.json'),
+                    workers=self.workers,
+                )
+        return self.fetcher
+
+    def fetched(self, target):
+        """fetched - doit uptodate check for fetch(), True if target was
+        fetched or revalidated in the last self.revalidate seconds
+
+        :param str target: local path for remote data
+        :return: True if target is up to date
+        :rtype: bool
+        """
+        return time.time() - self.get_fetcher().checked(target) < (
+            self.revalidate
+        )
+
+    def fetch(self, url, target):
+        """fetch - fetch remote data, see fetcher.Fetcher.fetch()
+
+        :param str url: URL
+        :param str target: local path
+        """
+        log("%s: %s" % (target, self.get_fetcher().fetch(url, target)))
+
+    def read_manifest(self):
+        """read_manifest - return the record of collected files, see
+        collect_file()
+
+        :return: {target: {'source':, 'size':, 'mtime':, ...}}
+        :rtype: dict
+        """
+        if self.manifest is None:
+            self.manifest = {}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as in_:
+                    self.manifest = json.load(in_)
+        return self.manifest
+
+    def collected(self, source, target):
+        """collected - doit uptodate check for collect_file(), compares
+        source's size and mtime with the manifest, without reading it
+
+        :param str source: original file
+        :param str target: collected file
+        :return: True if target is up to date
+        :rtype: bool
+        """
+        if not (os.path.exists(target) and os.path.exists(source)):
+            return False  # missing source makes collect_file() fail
+        stat = os.stat(source)
+        with self.manifest_lock:
+            info = self.read_manifest().get(target, {})
+        return (
+            info.get('source') == source
+            and info.get('size') == stat.st_size
+            and info.get('mtime') == stat.st_mtime
+        )
+
+    def collect_file(self, source, target):
+        """collect_file - collect a data file, see link_or_copy(), and
+        record it in the manifest, which is written by save_manifest()
+
+        :param str source: original file
+        :param str target: path in self.data_dir
+        """
+        stat = os.stat(source)
+        method, sha1 = link_or_copy(source, target)
+        with self.manifest_lock:
+            self.read_manifest()[target] = {
+                'source': source,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': sha1,
+                'method': method,
+            }
+            self.manifest_changed = True
+
+    def save_manifest(self):
+        """save_manifest - write the manifest if collect_file() changed it,
+        a teardown action for collection tasks, so it's written once per
+        run, not once per file
+        """
+        with self.manifest_lock:
+            if not self.manifest_changed:
+                return
+            make_dir(os.path.dirname(self.manifest_path))
+            with open(self.manifest_path + '.tmp', 'w') as out:
+                json.dump(self.manifest, out, indent=2, sort_keys=True)
+            if os.path.exists(self.manifest_path):  # for Windows
+                os.unlink(self.manifest_path)
+            os.rename(self.manifest_path + '.tmp', self.manifest_path)
+            self.manifest_changed = False
+
+    def make_data_loader(self, loader='fast', lazy=True):
+        """load_data - load global data for other tasks
+
+        Data with type 'chunked' (see data_type()) is never loaded all at
+        once, see ChunkedData.
+
+        :param str|function loader: key in CSV_LOADERS, or function
+            taking a path and returning a numpy structured array
+        :param bool lazy: put a LazyData in D, so data's only loaded if
+            a task uses it
+        """
+        loader = CSV_LOADERS.get(loader, loader)
 
         def load_global(name, D=self.D):
-            self.D.all_inputs.append(self.data_path(name))
-            self.D[name] = np.genfromtxt(
-                self.data_path(name),
-                delimiter=',',
-                names=True,
-                dtype=None,
-                invalid_raise=False,
-                loose=True,
-            )  # , encoding=None)
+            if self.data_path(name) not in self.D.all_inputs:
+                self.D.all_inputs.append(self.data_path(name))
+            def load():
+                return load_csv(
+                    self.data_path(name),
+                    os.path.join(self.data_dir, '_cache', name + '.npy'),
+                    loader=loader,
+                )
+
+            if self.data_type(name) == 'chunked':
+                self.D[name] = ChunkedData(
+                    name, self.data_path(name), self.record_access
+                )
+            elif lazy:
+                self.D[name] = LazyData(name, load, self.record_access)
+            else:
+                self.D[name] = load()
             globals()[name] = self.D[name]
 
         for name in self.data_sources:
-            if self.data_path(name).endswith('.csv') and name not in self.D:
+            if self.data_path(name).endswith('.csv'):
                 yield {
                     'name': name,
                     'actions': [(load_global, (name,))],
                     'task_dep': ['collect_data'],
+                    # loaded data stays in D, see watch() and reload_data()
+                    'uptodate': [lambda name=name: name in self.D],
                 }
 
     def make_env(self, here, filters):
-
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(
+        """make_env - shared Environment for rendering formats, see
+        get_env()
+
+        :param str here: pypanart's folder
+        :param list filters: names of filters, which must be passed as a
+            dict in the `_filters` variable when rendering, see
+            render_filter()
+        :return: environment
+        :rtype: jinja2.Environment
+        """
+        return get_env(
+            ('fmt', here),
+            lambda: jinja2.FileSystemLoader(
                 ['.', os.path.join(here, 'template')]
             ),
-            **JINJA_COMMON
+            dict((i, render_filter(i)) for i in filters),
         )
-        for k, v in filters.items():
-            env.filters[k] = v
-        return env
 
     def get_includes(self, fmt, ext):
         includes = []
@@ -459,20 +1131,33 @@ class PyPanArtState(object):
             "\\colorbox[HTML]{ebc631}{%s}" % i.strip() for i in ans
         )
 
-    def path_to_image(self, path, fmt):
+    def path_to_image(self, path, fmt, seen=None):
+        """path_to_image - `img` filter, path for image in output format
+
+        :param str path: image path, may omit extension
+        :param str fmt: output format
+        :param dict seen: results of earlier calls in this render, which
+            are reused rather than checking / copying files again
+        :return: path to image for document
+        :rtype: str
+        """
+        if seen is not None:
+            if path not in seen:
+                seen[path] = self.path_to_image(path, fmt)
+            return seen[path]
         ext_pick = '.pdf' if fmt in ('pdf', 'tex') else '.png'
         if path.startswith(self.data_dir):  # copy to img folder
             if not os.path.exists(path):
                 path += ext_pick
             if not os.path.exists(path):
-                print("NOTE: '%s' does not exist" % path)
+                log("NOTE: '%s' does not exist" % path)
             relpath = os.path.relpath(
                 path, start=self.data_dir
             )  # remove .data_dir
             base = "build/html/img/" if fmt == 'html' else "build/tmp/img/"
             img_path = os.path.join(base, relpath)
-            make_dir(os.path.dirname(img_path))
-            shutil.copyfile(path, img_path)
+            if os.path.exists(path):
+                sync_file(path, img_path)
             path = os.path.relpath(img_path, start=base)
         if fmt == 'html':
             base = "img/"  # relative to .html file
@@ -486,24 +1171,32 @@ class PyPanArtState(object):
             path += ext_pick
             test += ext_pick
         if not os.path.exists(test):
-            print("WARNING: '%s' does not exist" % test)
+            log("WARNING: '%s' does not exist" % test)
 
         return path
 
-    def latex_to_image(self, path, fmt):
-        path = self.path_to_image(path, fmt)
+    def latex_to_image(self, path, fmt, seen=None):
+        path = self.path_to_image(path, fmt, seen)
         name, ext = os.path.splitext(os.path.basename(path))
         return "fig/" + name.replace('.', '_') + ext
 
     def make_fmt(self, fmt, for_latex=False):
         """make_fmt - make html, pdf, docx, odt, etc. output
 
+        pandoc's exit code and run time are recorded in FMT_RESULTS, and
+        listed at the end of the run by run_task()
+
         :param str fmt: format to make
-        :param str extra: extra params to pass to pandoc
+        :param bool for_latex: prepare tex output for vanilla latex
+        :return: False if pandoc failed, for doit
         """
 
+        # files made here are per format, as formats are made in parallel,
+        # vanilla latex being separate from tex
+        variant = 'latex' if for_latex else fmt
         if fmt == 'latex':
-            self.make_fmt('tex', for_latex=True)
+            if self.make_fmt('tex', for_latex=True) is False:
+                return False
             self.make_fmt_latex()
             return
 
@@ -542,7 +1235,7 @@ class PyPanArtState(object):
             if os.path.exists(template):
                 template = "--template %s" % template
             else:
-                print("WARNING: template '%s' not found" % template)
+                log("WARNING: template '%s' not found" % template)
                 template = ''
 
         extra_fmt = {
@@ -555,8 +1248,9 @@ class PyPanArtState(object):
         }
         extra_fmt['tex'] = extra_fmt['pdf']
 
+        seen = {}  # see path_to_image()
         filters = {
-            'img': lambda path, fmt=fmt: self.path_to_image(path, fmt),
+            'img': lambda path, fmt=fmt: self.path_to_image(path, fmt, seen),
             'code': get_code_filter,
         }
         if fmt in ('pdf', 'tex'):
@@ -569,73 +1263,59 @@ class PyPanArtState(object):
             filters['FM'] = lambda text: "**%s**" % text
         env = self.make_env(here, filters)
 
+        category = 'make_fmt:%s' % fmt  # for profiler.span()
         template = env.get_template('build/tmp/%s.md' % self.basename)
         X = {'fmt': img_fmt[fmt]}
-        source_file = 'build/tmp/%s.%s.md' % (self.basename, fmt)
-        with open(source_file, 'w') as out:
-            out.write(
-                template.render(X=X, dcb='{{', open_comment='{!').encode(
-                    'utf-8'
-                )
-            )
+        render_args = dict(X=X, dcb='{{', open_comment='{!', _filters=filters)
+        source_file = 'build/tmp/%s.%s.md' % (self.basename, variant)
+        with profiler.span('render', category), open(source_file, 'w') as out:
+            out.write(template.render(**render_args).encode('utf-8'))
             out.write('\n')
 
-        # copy files from build/html/img to build/tmp/img in case
-        # other formats need them
-        for path, dirs, files in os.walk("build/html/img"):
-            for filename in files:
-                filepath = os.path.join(path, filename)
-                tmp_path = os.path.join(
-                    "build/tmp/img",
-                    os.path.relpath(filepath, start="build/html/img"),
-                )
-                if not os.path.exists(os.path.dirname(tmp_path)):
-                    make_dir(os.path.dirname(tmp_path))
-                shutil.copyfile(filepath, tmp_path)
+        with profiler.span('image sync', category):
+            self.sync_images()
 
         if fmt in ('pdf', 'tex'):
-            figs = self.get_figures(source_file)
-            figures = 'build/figures'
-            if os.path.exists(figures):
-                shutil.rmtree(figures)
-            for subdir in 'number', 'name', 'latex':
-                make_dir(os.path.join(figures, subdir))
-            for n, fig in enumerate(figs):
-                name, ext = os.path.splitext(os.path.basename(fig['file']))
-                shutil.copyfile(
-                    fig['file'],
-                    "%s/number/figure_%04d%s" % (figures, n + 1, ext),
-                )
-                outfile = "%s/name/%s" % (
-                    figures,
-                    os.path.basename(fig['file']),
-                )
-                assert not os.path.exists(outfile), outfile
-                shutil.copyfile(fig['file'], outfile)
-                outfile = "%s/latex/%s%s" % (
-                    figures,
-                    name.replace('.', '_'),
-                    ext,
-                )
-                assert not os.path.exists(outfile), outfile
-                shutil.copyfile(fig['file'], outfile)
+            with profiler.span('figure extraction', category):
+                figs = self.get_figures(source_file)
+                figures = os.path.join('build', 'figures', variant)
+                if os.path.exists(figures):
+                    shutil.rmtree(figures)
+                for subdir in 'number', 'name', 'latex':
+                    make_dir(os.path.join(figures, subdir))
+                for n, fig in enumerate(figs):
+                    name, ext = os.path.splitext(os.path.basename(fig['file']))
+                    shutil.copyfile(
+                        fig['file'],
+                        "%s/number/figure_%04d%s" % (figures, n + 1, ext),
+                    )
+                    outfile = "%s/name/%s" % (
+                        figures,
+                        os.path.basename(fig['file']),
+                    )
+                    assert not os.path.exists(outfile), outfile
+                    shutil.copyfile(fig['file'], outfile)
+                    outfile = "%s/latex/%s%s" % (
+                        figures,
+                        name.replace('.', '_'),
+                        ext,
+                    )
+                    assert not os.path.exists(outfile), outfile
+                    shutil.copyfile(fig['file'], outfile)
 
             # at this point, if prepping for latex, rewrite markdown with no
             # paths and at most one dot in figure paths, could not do this
             # before because we read the source file to find the figures
             # present
             if for_latex:
+                seen = {}
                 filters['img'] = lambda path, fmt=fmt: self.latex_to_image(
-                    path, fmt
+                    path, fmt, seen
                 )
-                env = self.make_env(here, filters)
-                template = env.get_template('build/tmp/%s.md' % self.basename)
-                with open(source_file, 'w') as out:
-                    out.write(
-                        template.render(
-                            X=X, dcb='{{', open_comment='{!'
-                        ).encode('utf-8')
-                    )
+                with profiler.span('render', category), open(
+                    source_file, 'w'
+                ) as out:
+                    out.write(template.render(**render_args).encode('utf-8'))
                     out.write('\n')
 
             with open(source_file, 'a') as out:
@@ -646,7 +1326,24 @@ class PyPanArtState(object):
         with open(source_file, 'a') as out:
             out.write("\n\n# References\n\n")
 
-        cmd = ['pandoc', '--standalone', '--from markdown-fancy_lists']
+        # parse once, number figures etc. in-process, and cache the AST,
+        # so pandoc only runs its writer here, see pandocast.py
+        with profiler.span('parse', category):
+            ast_file = cached_ast(
+                source_file,
+                [
+                    '--from',
+                    'markdown-fancy_lists',
+                    '--from',
+                    'markdown+pipe_tables',
+                ],
+                metadata=['bibliography=%s' % self.bib] if self.bib else [],
+                latex=fmt in ('pdf', 'tex'),
+                citeproc=not for_latex,  # --natbib instead
+                depends=[self.bib] if self.bib else [],
+            )
+
+        cmd = ['pandoc', '--standalone', '--from json']
         # PD2 '--smart',
 
         if self.bib:
@@ -654,28 +1351,8 @@ class PyPanArtState(object):
 
         cmd.extend(extra_fmt.get(fmt, []))
 
-        filters = "/home/tbrown/.local/lib/python2.7/site-packages"
-        if not os.path.exists(filters + "/pandoc_fignos.py"):
-            filters = (
-                "C:/Users/tbrown02/AppData/Roaming/Python/"
-                "Python27/site-packages"
-            )
-        if not os.path.exists(filters):
-            filters = ""
-        for filter_ in 'pandoc-fignos', 'pandoc-eqnos', 'pandoc-tablenos':
-            filter_ = (
-                ("%s/%s.py" % (filters, filter_.replace('-', '_')))
-                if filters
-                else filter_
-            )
-            cmd.append('--filter %s' % filter_)
-
         if for_latex:
             cmd.append('--natbib')
-        else:
-            cmd.append('--filter pandoc-citeproc')  # after other filters
-
-        cmd.append('--from markdown+pipe_tables')
 
         # pass include files through template processor and add to cmd. line
         if fmt in inc_fmt:
@@ -683,33 +1360,53 @@ class PyPanArtState(object):
             alt_ext = "._%s" % inc_fmt[fmt]
             includes = self.get_includes(fmt, ext)
             for inc_i in includes:
-                tmp_file = os.path.splitext(inc_i)[0] + alt_ext
+                tmp_file = "%s.%s%s" % (
+                    os.path.splitext(inc_i)[0], variant, alt_ext
+                )
                 tmp_file = os.path.join('build', 'tmp', tmp_file)
                 cmd.append('--include-in-header ' + tmp_file)
                 template = env.get_template(
                     'doc-setup/' + inc_i
                 )  # don't use os.path.join()
-                with open(tmp_file, 'w') as out:
+                with profiler.span('includes', category), open(
+                    tmp_file, 'w'
+                ) as out:
                     out.write(
                         template.render(
-                            X=X,
-                            C=self.C,
-                            D=self.D,
-                            dcb='{{',
-                            open_comment='{!',
+                            C=self.C, D=self.D, **render_args
                         ).encode('utf-8')
                     )
 
         # run pandoc
-        cmd.append(
-            "--output build/{fmt}/{basename}.{fmt} {source_file}".format(
-                fmt=fmt, basename=self.basename, source_file=source_file
-            )
+        out_file = "build/{fmt}/{basename}.{fmt}".format(
+            fmt=fmt, basename=self.basename
         )
-        print(" \\\n    ".join(cmd))
-        cmd = ' '.join(cmd)
-        make_dir("build/%s" % fmt)
-        Popen(cmd.split()).wait()
+        if for_latex:  # see make_fmt_latex()
+            out_file = "build/tmp/%s.latex.tex" % self.basename
+        cmd.append("--output %s %s" % (out_file, ast_file))
+        log(" \\\n    ".join(cmd))
+        cmd = ' '.join(cmd).split()
+        make_dir(os.path.dirname(out_file))
+        code, seconds, output = run_timed(cmd, 'pandoc', category)
+        FMT_RESULTS[variant] = code, seconds
+        if output.strip():
+            log("--- pandoc output for %s ---\n%s" % (variant, output.strip()))
+        if code != 0:
+            log("pandoc failed for %s, exit code %d" % (variant, code))
+            return False
+
+    def sync_images(self):
+        """sync_images - copy new or changed files from build/html/img to
+        build/tmp/img in case other formats need them
+        """
+        for path, dirs, files in os.walk("build/html/img"):
+            for filename in files:
+                filepath = os.path.join(path, filename)
+                tmp_path = os.path.join(
+                    "build/tmp/img",
+                    os.path.relpath(filepath, start="build/html/img"),
+                )
+                sync_file(filepath, tmp_path)
 
     def make_fmt_latex(self):
         """Move files around for vanilla latex"""
@@ -723,24 +1420,26 @@ class PyPanArtState(object):
                 self.bib, os.path.join(outdir, os.path.basename(self.bib))
             )
         shutil.copyfile(
-            "build/tex/%s.tex" % self.basename,
+            "build/tmp/%s.latex.tex" % self.basename,
             os.path.join(outdir, "%s.tex" % self.basename),
         )
-        for filename in os.listdir('build/figures/latex'):
+        figures = 'build/figures/latex/latex'  # see make_fmt()
+        for filename in os.listdir(figures):
             shutil.copyfile(
-                os.path.join('build/figures/latex', filename),
+                os.path.join(figures, filename),
                 os.path.join(outdir + '/fig', filename),
             )
 
         return
 
     def make_formats(self, file_dep=None, task_dep=None):
+        """use fmt:pdf, fmt:html, docx, odt, etc."""
         file_dep = file_dep or []
         task_dep = task_dep or []
-        file_dep += self.D.all_outputs + [
-            'parts/%s.md' % i for i in self.parts
-        ]
-        """use fmt:pdf, fmt:html, docx, odt, etc."""
+        part_files = ['parts/%s.md' % i for i in self.parts]
+        # other .md files in parts/ may be {% include %}ed by the parts
+        part_files += sorted(set(glob('parts/*.md')) - set(part_files))
+        file_dep += self.D.all_outputs + part_files
         yield {
             'name': 'md',
             'actions': [(self.make_markdown,)],
@@ -750,6 +1449,8 @@ class PyPanArtState(object):
             'targets': ['build/tmp/%s.md' % self.basename],
         }
         file_dep += ['build/tmp/%s.md' % self.basename]
+        # templates and includes, see make_fmt() and get_includes()
+        file_dep += sorted(glob('doc-setup/*'))
         for fmt in 'html pdf odt docx tex latex'.split():
             yield {
                 'name': fmt,
@@ -759,13 +1460,23 @@ class PyPanArtState(object):
                 'task_dep': task_dep + ['fmt:md'],
                 'targets': ['build/tmp/%s.%s' % (self.basename, fmt)],
             }
+        # only an alias for the formats in ALL_FORMATS, so `fmt` doesn't
+        # make them twice, doit runs them in parallel, see run_task()
+        yield {
+            'name': 'all',
+            'actions': None,
+            'task_dep': ['fmt:%s' % i for i in ALL_FORMATS],
+        }
 
-    def make_images(self):
+    def make_images(self, batch=True):
         """make png / pdf figures from svg sources
 
         NOTE: files made / copied to build/html/img will be copied to
         build/tmp/img later (currently in make_fmt()) to make them
         available for other formats like .odt.
+
+        :param bool batch: export through one long running `inkscape
+            --shell` process rather than starting inkscape for each file
         """
         inkscape = 'inkscape'
         if sys.platform == 'win32':
@@ -782,19 +1493,26 @@ class PyPanArtState(object):
                         out = os.path.join(
                             out_path, path, filename[:-4] + '.' + format
                         )
+                        if batch:
+                            action = (
+                                inkscape_export,
+                                (inkscape.strip('"'), src, out, format),
+                            )
+                        else:
+                            action = (
+                                "{inkscape} --export-{format}={out} "
+                                "--without-gui --export-area-page {svg}"
+                            ).format(
+                                svg=src,
+                                out=out,
+                                format=format,
+                                inkscape=inkscape,
+                            )
                         yield {
                             'name': "%s from %s" % (format, src),
                             'actions': [
                                 (make_dir, (os.path.join(out_path, path),)),
-                                (
-                                    "{inkscape} --export-{format}={out} "
-                                    "--without-gui --export-area-page {svg}"
-                                ).format(
-                                    svg=src,
-                                    out=out,
-                                    format=format,
-                                    inkscape=inkscape,
-                                ),
+                                action,
                             ],
                             'file_dep': [src],
                             'targets': [out],
@@ -815,12 +1533,6 @@ class PyPanArtState(object):
     def make_markdown(self):
         """make_markdown - make markdown
         """
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader('parts'),
-            # loader=jinja2.PackageLoader('parts', '.'),
-            **JINJA_COMMON
-        )
-
         def img(path):
             return "{{'%s'|img}}" % path
 
@@ -840,28 +1552,57 @@ class PyPanArtState(object):
             text[1:1] = ['|'.join('---' for i in table[0])]
             return '\n'.join(text)
 
-        env.filters['img'] = img
-        env.filters['code'] = get_code_filter
-        env.filters['pipe_table'] = pipe_table
-        env.filters['FM'] = lambda text: '{{"%s"|FM}}' % text
+        env = get_env(
+            ('parts',),
+            lambda: jinja2.FileSystemLoader('parts'),
+            {
+                'img': img,
+                'code': io_filter(get_code_filter),
+                'pipe_table': pipe_table,
+                'FM': lambda text: '{{"%s"|FM}}' % text,
+            },
+        )
 
         X = {'fmt': '{{X.fmt}}', 'now': time.asctime()}
+        context = dict(
+            C=self.C,
+            D=self.D,
+            X=X,
+            dcb='{{dcb}}',
+            open_comment='{{open_comment}}',
+        )
 
-        make_dir('build/tmp')
+        # rendered parts are cached in build/tmp/parts/<key>.md, where key
+        # hashes the part's source and the C / D / X values it reads
+        cache_dir = 'build/tmp/parts'
+        make_dir(cache_dir)
+        used = set()
         with open('build/tmp/%s.md' % self.basename, 'w') as out:
             for part in self.parts:
-                template = env.get_template(os.path.basename(part + '.md'))
-                out.write(
-                    template.render(
-                        C=self.C,
-                        D=self.D,
-                        X=X,
-                        dcb='{{dcb}}',
-                        open_comment='{{open_comment}}',
-                    ).encode('utf-8')
-                )
+                name = os.path.basename(part + '.md')
+                key = part_cache_key(env, name, context)
+                cached = key and os.path.join(cache_dir, key + '.md')
+                if cached and os.path.exists(cached):
+                    with open(cached) as in_:
+                        text = in_.read()
+                else:
+                    log("Rendering part %s" % part)
+                    with profiler.span(name, 'jinja'):
+                        template = env.get_template(name)
+                        text = template.render(**context).encode('utf-8')
+                    if cached:
+                        with open(cached, 'w') as fragment:
+                            fragment.write(text)
+                used.add(cached)
+                out.write(text)
                 out.write('\n\n')
 
+        # drop fragments from old versions of parts
+        for filename in os.listdir(cache_dir):
+            filepath = os.path.join(cache_dir, filename)
+            if filepath not in used:
+                os.unlink(filepath)
+
     def one_task(self, **kwargs):
         """one_task - decorator - simple task definition
 
@@ -880,8 +1621,20 @@ class PyPanArtState(object):
             self.D.all_outputs.extend(kwargs['targets'])
 
         def one_task_maker(function):
+            # record task name for LazyData access, doit still sees
+            # function's arguments, like `targets`, via __wrapped__
+            @functools.wraps(function)
+            def named(*args, **kwargs):
+                set_task_name(function.__name__)
+                try:
+                    return function(*args, **kwargs)
+                finally:  # even if it fails, for the thread's next task
+                    set_task_name(None)
+
+            actions = [named]
+
             def function_task():
-                d = {'actions': [function]}
+                d = {'actions': actions}
                 d.update(kwargs)
                 return d
 
@@ -892,44 +1645,72 @@ class PyPanArtState(object):
 
     def preprocess_odt(self):
         """preprocess_odt - process reference ODT file for footer includes
-        etc."""
-        # extract the reference ODT
-        odt_dir = tempfile.mkdtemp()
+        etc.
+
+        The result is cached in build/tmp/odt, keyed on the reference file
+        and the C / D values its styles.xml template reads.
+
+        :return: path to processed reference ODT
+        :rtype: str
+        """
         here = os.path.dirname(__file__)
         # FIXME look for user's modified version first
-        zipfile.ZipFile(
-            '%s/template/doc-setup/odt.reference' % here
-        ).extractall(odt_dir)
-
-        # run template substitution on it
-        # not sure how to instanciate jinja2.FileSystemLoader from filesystem
-        # root for Windows, so use DictLoader
-        styles_old = os.path.join(odt_dir, 'styles.xml')
-        styles_new = os.path.join(odt_dir, 'styles_new.xml')
-        template_dict = {'styles': open(styles_old).read().decode('utf-8')}
-        env = jinja2.Environment(
-            loader=jinja2.DictLoader(template_dict), **JINJA_COMMON
-        )
-        template = env.get_template('styles')
-        with open(styles_new, 'w') as out:
-            out.write(template.render(C=self.C, D=self.D).encode('utf-8'))
-        shutil.copyfile(styles_new, styles_old)
+        reference = '%s/template/doc-setup/odt.reference' % here
+        odt_dir = 'build/tmp/odt'
+        make_dir(odt_dir)
 
-        # zip it up again
-        zip_filepath = os.path.join(odt_dir, 'reference.odt')
-        zip_file = zipfile.ZipFile(zip_filepath, 'w')
-        for path, dirs, files in os.walk(odt_dir):
-            for filename in files:
-                if filename == 'reference.odt':
-                    continue
-                zip_file.write(
-                    os.path.join(path, filename),
-                    os.path.relpath(os.path.join(path, filename), odt_dir),
-                )
-        zip_file.close()
+        with zipfile.ZipFile(reference) as zip_in:
+            template = get_string_template(
+                zip_in.read('styles.xml').decode('utf-8')
+            )
+            context = dict(C=self.C, D=self.D)
+            key = part_cache_key(template.environment, template.name, context)
+            if key is None:
+                zip_filepath = os.path.join(odt_dir, 'reference.odt')
+            else:
+                key = hashlib.sha1(
+                    (file_digest(reference) + key).encode('utf-8')
+                ).hexdigest()
+                zip_filepath = os.path.join(odt_dir, key + '.odt')
+                if os.path.exists(zip_filepath):
+                    return zip_filepath
+
+            # copy entries in order, so 'mimetype' stays first, replacing
+            # styles.xml with the rendered template, via a unique temporary
+            # file, as fmt:odt may run more than once at a time
+            handle, tmp_path = tempfile.mkstemp(dir=odt_dir, suffix='.tmp')
+            os.close(handle)
+            with zipfile.ZipFile(tmp_path, 'w') as zip_out:
+                for info in zip_in.infolist():
+                    if info.filename == 'styles.xml':
+                        data = template.render(**context).encode('utf-8')
+                    else:
+                        data = zip_in.read(info)
+                    zip_out.writestr(info, data)
+
+        # drop references built for old C / D values
+        for filename in os.listdir(odt_dir):
+            filepath = os.path.join(odt_dir, filename)
+            if filename.endswith('.odt') and filepath != zip_filepath:
+                try:
+                    os.unlink(filepath)
+                except OSError:  # another thread may have just removed it
+                    pass
+        if os.path.exists(zip_filepath) and sys.platform == 'win32':
+            os.unlink(zip_filepath)
+        os.rename(tmp_path, zip_filepath)
 
         return zip_filepath
 
+    def record_access(self, name):
+        """record_access - note the running task used dataset `name`
+
+        :param str name: name of dataset
+        """
+        task = getattr(TASK, 'name', None)
+        if task:
+            self.data_access.setdefault(name, set()).add(task)
+
     def run_with_context(self, func):
         """Run func(), ensuring any changes to C are saved
 
@@ -944,15 +1725,306 @@ class PyPanArtState(object):
             func()
             self.C._metadata.run.failed = False
         finally:
-            del self.C['create_doit_tasks']  # see get_context_objects()
-            make_dir(os.path.dirname(self.C._metadata._filepath))
-            json.dump(
-                self.C,
-                open(self.C._metadata._filepath, 'w'),
-                indent=2,
-                sort_keys=True,
+            # see get_context_objects()
+            dict.__delitem__(self.C, 'create_doit_tasks')
+            self.checkpoint()
+
+    def checkpoint(self):
+        """checkpoint - record data use and save_state(), e.g. at the end
+        of a run, or after each rebuild in watch()
+        """
+        # doit's dummy method, see _get_context_objects(), isn't state
+        dummy = dict.pop(self.C, 'create_doit_tasks', None)
+        try:
+            for name, tasks in self.data_access.items():
+                self.C._metadata.data_access[name] = sorted(tasks)
+            self.save_state()
+        finally:
+            if dummy is not None:
+                dict.__setitem__(self.C, 'create_doit_tasks', dummy)
+
+    def source_files(self):
+        """source_files - local files data is collected from, see
+        make_data_collector()
+
+        :return: {path: data name}
+        :rtype: dict
+        """
+        ans = {}
+        for name, sources in self.data_sources.items():
+            for source in self.as_list(sources):
+                source = source.split(':TYPE:')[0]
+                if '://' in source or '{{' in source:
+                    continue  # remote, or depends on C / D
+                for path in glob(os.path.splitext(source)[0] + '*'):
+                    ans[os.path.normpath(path)] = name
+        return ans
+
+    def reload_data(self, names):
+        """reload_data - drop loaded data so make_data_loader() reloads it,
+        e.g. when its source changes
+
+        :param list names: data names
+        :return: tasks which used the data, in this or the last run
+        :rtype: list
+        """
+        tasks = set()
+        used = DefaultDotDict.peek(self.C._metadata, 'data_access')
+        for name in names:
+            self.D.pop(name, None)
+            tasks.update(self.data_access.get(name, ()))
+            tasks.update(used.get(name) or ())
+        return sorted(tasks)
+
+    def save_state(self):
+        """save_state - save C to its state file, if anything outside
+        C._metadata has changed
+
+        With state_format 'journal', changes are appended to
+        <statefile>.journal, and folded into the state file by
+        compact_state() when the journal's bigger than the state file.
+        The state file itself is always complete JSON, for json_load(),
+        but out of date until compaction, so anything else reading it
+        must replay the journal too, with DefaultDotDict.json_replay(),
+        as _get_context_objects() does.
+        """
+        filepath = self.C._metadata._filepath
+        tracker = self.C._tracker
+        if (
+            tracker is not None
+            and os.path.exists(filepath)
+            and not tracker.paths(ignore=[('_metadata',)])
+        ):
+            print("No changes for '%s'" % filepath)
+            return
+        # only now, so runs that don't save don't run git etc.
+        resolve_lazy(self.C)
+        journal = filepath + '.journal'
+        if (
+            self.state_format == 'journal'
+            and tracker is not None
+            and os.path.exists(filepath)
+        ):
+            with open(journal, 'a') as out:
+                DefaultDotDict.json_journal(self.C, out, tracker.paths())
+            tracker.reset()
+            if os.path.getsize(journal) > os.path.getsize(filepath):
+                self.compact_state()
+        else:
+            self.compact_state()
+        print("Results in '%s'" % filepath)
+
+    def compact_state(self):
+        """compact_state - write all of C to its state file and remove
+        any journal, see save_state()
+        """
+        filepath = self.C._metadata._filepath
+        make_dir(os.path.dirname(filepath))
+        with open(filepath + '.tmp', 'w') as out:
+            if self.state_format == 'compact':
+                json.dump(self.C, out, separators=(',', ':'))
+            else:
+                json.dump(self.C, out, indent=2, sort_keys=True)
+        if os.path.exists(filepath):  # for Windows
+            os.unlink(filepath)
+        os.rename(filepath + '.tmp', filepath)
+        if os.path.exists(filepath + '.journal'):
+            os.unlink(filepath + '.journal')
+        if self.C._tracker is not None:
+            self.C._tracker.reset()
+
+
+def resolve_lazy(obj):
+    """resolve_lazy - replace LazyValues in nested dicts with their values
+
+    :param dict obj: e.g. C
+    """
+    for key, value in obj.items():
+        if isinstance(value, LazyValue):
+            dict.__setitem__(obj, key, value.get())
+        elif isinstance(value, dict):
+            resolve_lazy(value)
+
+
+def find_git_dir(path='.'):
+    """find_git_dir - find the .git folder for path
+
+    :param str path: path in repository
+    :return: path to .git folder, None if not found or not a folder
+    :rtype: str
+    """
+    path = os.path.abspath(path)
+    while True:
+        git_dir = os.path.join(path, '.git')
+        if os.path.exists(git_dir):
+            return git_dir if os.path.isdir(git_dir) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def git_info():
+    """git_info - HEAD's commit hash, with '+mods' if git diff-index
+    lists changes
+
+    The commit hash is cached in GIT_INFO_PATH, keyed on the mtimes of
+    .git/HEAD, the ref it points to, .git/index, and .git/packed-refs,
+    but git diff-index is always run, as editing files doesn't change
+    any of those.  The result is kept in GIT_INFO until it's cleared,
+    e.g. by PyPanArtState.new_run().
+
+    :return: {'commit': <hash>, 'commit_short': <7 char. hash>}
+    :rtype: dict
+    """
+
+    def mtime(path):
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    with GIT_LOCK:
+        if GIT_INFO:
+            return GIT_INFO
+        key = commit = None
+        git_dir = find_git_dir()
+        if git_dir:
+            key = [
+                mtime(os.path.join(git_dir, i))
+                for i in ('HEAD', 'index', 'packed-refs')
+            ]
+            with open(os.path.join(git_dir, 'HEAD')) as in_:
+                head = in_.read().strip()
+            if head.startswith('ref:'):
+                key.append(mtime(os.path.join(git_dir, head[4:].strip())))
+        if key and os.path.exists(GIT_INFO_PATH):
+            with open(GIT_INFO_PATH) as in_:
+                cached = json.load(in_)
+            if cached.get('key') == key:
+                commit = cached.get('commit')
+
+        if commit is None:
+            cmd = 'git rev-parse --verify -q HEAD'.split()
+            proc = Popen(cmd, stdout=PIPE)
+            commit = proc.communicate()[0].decode('utf-8').strip()
+            if key:
+                make_dir(os.path.dirname(GIT_INFO_PATH))
+                with open(GIT_INFO_PATH, 'w') as out:
+                    json.dump({'key': key, 'commit': commit}, out)
+        mods = ''
+        if commit:  # not outside a repository
+            proc = Popen('git diff-index --quiet HEAD --'.split())
+            mods = '+mods' if proc.wait() else ''
+        GIT_INFO.update(commit=commit + mods, commit_short=commit[:7] + mods)
+        return GIT_INFO
+
+
+def part_metadata(path):
+    """part_metadata - title and author info. from YAML in a part
+
+    :param str path: path to part
+    :return: dict with title, authors, corresponding, {} on failure
+    :rtype: dict
+    """
+    try:
+        import yaml
+
+        with open(path) as f:
+            dataMap = yaml.safe_load(f)
+        ans = {'title': dataMap['title']}
+        ans['authors'] = ', '.join(i['name'] for i in dataMap['author'])
+        corresponding = [
+            i for i in dataMap['author'] if i.get('corresponding')
+        ]
+        fmt = "{c[email]} {c[name]} corresponding author"
+        if corresponding:
+            ans['corresponding'] = fmt.format(c=corresponding[0])
+        else:
+            ans['corresponding'] = ""
+        return ans
+    except Exception:
+        log("Parsing part 0 as YAML failed")
+        return {}
+
+
+def get_env(key, loader, filters=None):
+    """get_env - return the shared jinja2.Environment for a loader
+    configuration, creating it if needed, with compiled templates cached
+    in JINJA_CACHE across builds
+
+    :param tuple key: identifies the loader configuration
+    :param function loader: returns a jinja2 loader for a new Environment
+    :param dict filters: filters for a new Environment, must not vary
+        between calls with the same key, see render_filter()
+    :return: environment
+    :rtype: jinja2.Environment
+    """
+    with JINJA_LOCK:
+        if key not in JINJA_ENVS:
+            make_dir(JINJA_CACHE)
+            env = PeekEnvironment(
+                loader=loader(),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(
+                    os.path.abspath(JINJA_CACHE)
+                ),
+                **JINJA_COMMON
             )
-            print("Results in '%s'" % self.C._metadata._filepath)
+            env.filters.update(filters or {})
+            JINJA_ENVS[key] = env
+        return JINJA_ENVS[key]
+
+
+def get_string_template(text):
+    """get_string_template - template from text, via a shared Environment
+    so the compiled template is cached
+
+    Not sure how to instanciate jinja2.FileSystemLoader from filesystem
+    root for Windows, so templates are named by the hash of their text.
+
+    :param str text: template text
+    :return: template
+    :rtype: jinja2.Template
+    """
+    name = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    env = get_env(('strings',), lambda: jinja2.DictLoader(JINJA_STRINGS))
+    with JINJA_LOCK:
+        JINJA_STRINGS[name] = text
+    return env.get_template(name)
+
+
+def render_filter(name):
+    """render_filter - filter calling the filter `name` from the dict
+    passed as the `_filters` template variable, so a shared Environment
+    can use different filter functions for each render
+
+    :param str name: name of filter
+    :return: filter function
+    :rtype: function
+    """
+
+    @pass_context
+    def filter_(context, *args, **kwargs):
+        return context['_filters'][name](*args, **kwargs)
+
+    return filter_
+
+
+def io_filter(function):
+    """io_filter - filter calling function, which Jinja won't call at
+    compile time for constant arguments, e.g. {{ 'x.py name'|code }}, as
+    the result would be saved in the bytecode cache, see get_env(), so
+    changes in files function reads would never be seen
+
+    Jinja never folds filters taking the context, see render_filter().
+
+    :param function function: filter reading files etc.
+    :return: filter function
+    :rtype: function
+    """
+
+    @pass_context
+    def filter_(context, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    return filter_
 
 
 def make_dir(path):
@@ -961,19 +2033,551 @@ def make_dir(path):
     :param str path: path to dir
     """
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:  # parallel task may have just made it
+            if not os.path.isdir(path):
+                raise
 
 
-def run_task(module, task):
+def set_task_name(name):
+    """set_task_name - set TASK.name for this thread, see one_task()
+
+    :param str name: task name, or None
+    """
+    TASK.name = name
+
+
+def get_workers(workers=None):
+    """get_workers - number of parallel workers to use
+
+    :param int workers: number of workers, defaults to $PYPANART_JOBS
+        or the number of CPUs
+    :return: number of workers
+    :rtype: int
+    """
+    if workers is None:
+        workers = os.environ.get('PYPANART_JOBS') or cpu_count()
+    return max(1, int(workers))
+
+
+def log(text):
+    """log - print a line (or lines) without interleaving with output
+    from other threads
+
+    Writes to sys.__stdout__, because doit swaps sys.stdout for each
+    action to capture its output, which isn't thread safe.
+
+    :param str text: text to print
+    """
+    with LOG_LOCK:
+        sys.__stdout__.write(text + '\n')
+        sys.__stdout__.flush()
+
+
+def run_task(module, task, workers=None, profile=None, user_threads=None):
     """
     run_task - Have doit run the named task
 
+    Tasks run in parallel threads, rather than processes, so they share
+    the C and D objects.  User tasks, see user_task(), still run one at
+    a time, as code like matplotlib's pyplot, which draws on a global
+    figure, isn't thread safe, unless `user_threads` is set.
+
+    With profiling, time etc. for each task, and phases of tasks, see
+    profiler.py, is saved in PROFILE_PATH, with a Chrome trace-event
+    version, and the top `profile` items are listed at the end.
+
     :param module module: module containing tasks
     :param str task: task to run
+    :param int workers: number of parallel workers, defaults to
+        $PYPANART_JOBS or the number of CPUs
+    :param int profile: profile, listing this many items, defaults to
+        $PYPANART_PROFILE, or 0, no profiling
+    :param bool user_threads: run user tasks in parallel too, only if
+        they're thread safe, defaults to $PYPANART_USER_THREADS, or False
     """
     start = time.time()
-    DoitMain(ModuleTaskLoader(module)).run([task])
+    args = [task]
+    workers = get_workers(workers)
+    if workers > 1 and task not in DOIT_COMMANDS:
+        args = ['run', '-n', str(workers), '-P', 'thread', task]
+    if profile is None:
+        profile = int(os.environ.get('PYPANART_PROFILE') or 0)
+    if profile:
+        profiler.enable()
+    if user_threads is None:
+        user_threads = bool(os.environ.get('PYPANART_USER_THREADS'))
+    loader = TaskLoader(
+        module, profile=bool(profile), user_threads=user_threads
+    )
+    FMT_RESULTS.clear()
+    # doit swaps sys.stdout / stderr to capture each action's output,
+    # which parallel threads can leave swapped when doit's done
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+        DoitMain(loader).run(args)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        results = profiler.disable()
+    for fmt, (code, seconds) in sorted(FMT_RESULTS.items()):
+        print("%6s: exit code %d, %.2f seconds" % (fmt, code, seconds))
     print("%.2f seconds" % (time.time() - start))
+    if results:
+        trace_path = results.save(PROFILE_PATH)
+        print(results.summary(profile))
+        print("Profile in %s, %s" % (PROFILE_PATH, trace_path))
+
+
+def watch(
+    module, task='fmt:html', paths=None, workers=None, profile=None,
+    interval=0.25, user_threads=None,
+):
+    """
+    watch - run_task(), then run it again whenever inputs change
+
+    The process stays resident, so C, D, loaded data, parsed templates,
+    git info. etc. are reused between builds, and doit's file_dep checks
+    re-run only the tasks affected by a change.  When a data source
+    changes its loaded copy is dropped, and tasks which used it (see
+    PyPanArtState.record_access()) are forgotten so doit re-runs them.
+    C is saved after each build.  Stop with Ctrl-C.
+
+    :param module module: module containing tasks
+    :param str task: task to run
+    :param list paths: files and folders to watch, defaults to
+        WATCH_PATHS, data sources, and config files
+    :param int workers: number of parallel workers, see run_task()
+    :param int profile: profile each build, see run_task()
+    :param float interval: seconds between checks when polling, see
+        FileWatcher
+    :param bool user_threads: run user tasks in parallel, see run_task()
+    """
+    if not isinstance(module, dict):
+        module = vars(module)
+    state = None
+    for value in module.values():
+        if isinstance(value, PyPanArtState):
+            state = value
+            break
+    sources = state.source_files() if state else {}
+    if paths is None:
+        paths = [i for i in WATCH_PATHS if os.path.exists(i)]
+        paths += sorted(sources)
+        if state:
+            configs = state.C._metadata.run.configs or []
+            paths += [i for i in configs if i and os.path.exists(i)]
+    watcher = FileWatcher(paths, interval=interval)
+    while True:
+        try:
+            run_task(
+                module, task, workers=workers, profile=profile,
+                user_threads=user_threads,
+            )
+        except Exception as exc:  # keep watching, the edit may fix it
+            print("Build failed: %r" % exc)
+        if state:
+            state.checkpoint()
+        print(
+            "Watching %s for changes, Ctrl-C to stop" % ', '.join(paths)
+        )
+        changed = watcher.changes()
+        if state:
+            state.new_run()
+        print("Changed: %s" % ' '.join(changed))
+        names = set(sources[i] for i in changed if i in sources)
+        if names and state:
+            forget = state.reload_data(names)
+            if forget:
+                DoitMain(ModuleTaskLoader(module)).run(['forget'] + forget)
+
+
+def user_task(task):
+    """user_task - True if a doit task runs Python code from outside
+    pypanart, e.g. one_task() functions, as opposed to pypanart's own
+    thread safe tasks, see run_task()
+
+    :param doit.task.Task task: task
+    :return: True if task has user Python actions
+    :rtype: bool
+    """
+    return any(
+        isinstance(action, PythonAction)
+        and getattr(action.py_callable, '__module__', None) != __name__
+        for action in task.actions
+    )
+
+
+def serialized(function, lock):
+    """serialized - wrap function to run holding lock
+
+    :param function function: function to wrap
+    :param Lock lock: lock to hold
+    :return: wrapped function
+    :rtype: function
+    """
+
+    def wrapper(*args, **kwargs):
+        with lock:
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def profiled(function, name, category):
+    """profiled - wrap function to run in a profiler.span()
+
+    :param function function: function to wrap
+    :param str name: span name
+    :param str category: span category
+    :return: wrapped function
+    :rtype: function
+    """
+
+    def wrapper(*args, **kwargs):
+        with profiler.span(name, category):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def inkscape_export(inkscape, svg, out, format):
+    """inkscape_export - export an SVG via a shared InkscapeShell, falling
+    back to a one off inkscape process if the shell fails
+
+    :param str inkscape: path to inkscape executable
+    :param str svg: path to SVG file
+    :param str out: path to output file
+    :param str format: 'png' or 'pdf'
+    :return: True if out was written, for doit
+    :rtype: bool
+    """
+    with profiler.span(os.path.basename(svg), 'inkscape'):
+        # borrow an idle shell, so there are only as many shells as
+        # concurrent exports, however many threads doit runs, e.g. in
+        # watch()'s rebuilds
+        with INKSCAPE_LOCK:
+            idle = INKSCAPE_SHELLS.setdefault(inkscape, [])
+            shell = idle.pop() if idle else None
+        if shell is None:
+            shell = InkscapeShell(inkscape)
+            atexit.register(shell.close)
+        try:
+            return shell.export(svg, out, format)
+        except (InkscapeShellError, OSError, IOError) as exc:
+            log("NOTE: inkscape --shell failed (%s), exporting directly" % exc)
+            shell.proc = None
+        finally:
+            with INKSCAPE_LOCK:
+                INKSCAPE_SHELLS[inkscape].append(shell)
+        cmd = [
+            inkscape,
+            '--export-%s=%s' % (format, out),
+            '--without-gui',
+            '--export-area-page',
+            svg,
+        ]
+        return Popen(cmd).wait() == 0 and os.path.exists(out)
+
+
+def link_or_copy(source, target):
+    """link_or_copy - make target a copy on write clone (reflink) of
+    source, or failing that a hard link, or failing that a copy
+
+    NOTE: a hard linked target *is* the source, so tasks must not modify
+    collected files in place.
+
+    :param str source: path to source file
+    :param str target: path to target file
+    :return: method used, 'reflink', 'link', or 'copy', and SHA1 of the
+        content if it was read to copy it, else None
+    :rtype: (str, str)
+    """
+    if os.path.exists(target):
+        os.unlink(target)
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return 'reflink', None
+        except (IOError, OSError):
+            os.unlink(target)
+    try:
+        os.link(source, target)
+        return 'link', None
+    except (AttributeError, OSError):  # no os.link() on Windows Python 2
+        pass
+    digest = hashlib.sha1()
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        for block in iter(lambda: src.read(1 << 20), b''):
+            digest.update(block)
+            dst.write(block)
+    shutil.copystat(source, target)
+    return 'copy', digest.hexdigest()
+
+
+def sync_file(source, target):
+    """sync_file - update target from source with link_or_copy(), unless
+    it's the same size and modification time already
+
+    :param str source: path to source file
+    :param str target: path to target file
+    :return: True if target was updated
+    :rtype: bool
+    """
+    src = os.stat(source)
+    with SYNC_LOCK:  # parallel formats may sync the same files
+        if os.path.exists(target):
+            dst = os.stat(target)
+            if (
+                dst.st_size == src.st_size
+                and abs(dst.st_mtime - src.st_mtime) < 0.001
+            ):
+                return False
+        make_dir(os.path.dirname(target))
+        link_or_copy(source, target)
+    return True
+
+
+def genfromtxt_csv(path):
+    """genfromtxt_csv - load a CSV file with np.genfromtxt()
+
+    :param str path: path to CSV file
+    :return: data from CSV file
+    :rtype: numpy.ndarray
+    """
+    return np.genfromtxt(
+        path,
+        delimiter=',',
+        names=True,
+        dtype=None,
+        invalid_raise=False,
+        loose=True,
+    )  # , encoding=None)
+
+
+def fast_csv(path):
+    """fast_csv - load a CSV file with fastcsv.read_csv(), falling back
+    to np.genfromtxt() for files it can't handle
+
+    :param str path: path to CSV file
+    :return: data from CSV file
+    :rtype: numpy.ndarray
+    """
+    try:
+        return fastcsv.read_csv(path)
+    except fastcsv.NotSimpleCSV as exc:
+        log("NOTE: %s, reading '%s' with genfromtxt" % (exc, path))
+        return genfromtxt_csv(path)
+
+
+CSV_LOADERS = {'genfromtxt': genfromtxt_csv, 'fast': fast_csv}
+
+
+def load_csv(path, cache_path, loader=genfromtxt_csv):
+    """load_csv - load a CSV file as a numpy structured array, using a
+    .npy copy at cache_path when it's up to date
+
+    The .npy file is memory mapped (copy on write), so loading is quick and
+    uses no memory until the data is read.  cache_path + '.json' records the
+    loader used and the size, mtime and SHA1 of the CSV file, the SHA1 is
+    only checked if the size matches but the mtime doesn't.
+
+    :param str path: path to CSV file
+    :param str cache_path: path for .npy file
+    :param function loader: function to load CSV if cache is out of date
+    :return: data from CSV file
+    :rtype: numpy.ndarray
+    """
+    stat = os.stat(path)
+    meta_path = cache_path + '.json'
+    loader_name = "%s.%s" % (
+        getattr(loader, '__module__', None),
+        getattr(loader, '__name__', repr(loader)),
+    )
+    meta = {}
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path) as in_:
+            meta = json.load(in_)
+    if (
+        meta.get('loader') == loader_name
+        and meta.get('size') == stat.st_size
+    ):
+        if meta.get('mtime') != stat.st_mtime:
+            if meta.get('sha1') == file_digest(path):
+                meta['mtime'] = stat.st_mtime
+                with open(meta_path, 'w') as out:
+                    json.dump(meta, out)
+            else:
+                meta = {}
+        if meta:
+            return np.load(cache_path, mmap_mode='c')
+
+    with profiler.span(os.path.basename(path), 'csv'):
+        data = loader(path)
+    if data.dtype.hasobject:  # can't be memory mapped
+        return data
+    make_dir(os.path.dirname(cache_path))
+    tmp_path = cache_path + '.tmp.npy'  # np.save() adds .npy if missing
+    np.save(tmp_path, data)
+    if os.path.exists(cache_path):  # for Windows
+        os.unlink(cache_path)
+    os.rename(tmp_path, cache_path)
+    with open(meta_path, 'w') as out:
+        json.dump(
+            {
+                'loader': loader_name,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha1': file_digest(path),
+            },
+            out,
+        )
+    return np.load(cache_path, mmap_mode='c')
+
+
+def run_timed(cmd, name=None, category=None):
+    """run_timed - run a command, collecting its output
+
+    :param list cmd: command and arguments
+    :param str name: name for profiler.span(), default the command
+    :param str category: category for profiler.span(), default the
+        command's basename
+    :return: exit code, seconds elapsed, combined stdout / stderr
+    :rtype: (int, float, str)
+    """
+    start = time.time()
+    category = category or os.path.basename(cmd[0])
+    with profiler.span(name or cmd[0], category):
+        proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+        output, _ = proc.communicate()
+    output = output.decode('utf-8', 'replace')
+    return proc.returncode, time.time() - start, output
+
+
+def template_reads(node, roots, reads, files):
+    """template_reads - find values a Jinja template reads from context
+
+    Adds (root, key, key, ...) tuples for expressions like `C.a.b` or
+    `D.x['y']` to reads, truncated at any non-constant key, and source
+    files read by the `code` filter to files.
+
+    :param jinja2.nodes.Node node: template AST node
+    :param set roots: context names to track, e.g. {'C', 'D'}
+    :param set reads: set to add paths to
+    :param set files: set to add source file paths to
+    :return: False if reads can't be determined statically
+    :rtype: bool
+    """
+    if isinstance(
+        node, (nodes.Include, nodes.Import, nodes.FromImport, nodes.Extends)
+    ):
+        return False
+    if isinstance(node, nodes.Filter) and node.name == 'code':
+        if not isinstance(node.node, nodes.Const):
+            return False
+        files.add(node.node.value.split()[0])
+    if isinstance(node, (nodes.Getattr, nodes.Getitem)):
+        keys = []
+        ok = True
+        while isinstance(node, (nodes.Getattr, nodes.Getitem)):
+            if isinstance(node, nodes.Getattr):
+                keys.insert(0, node.attr)
+            elif isinstance(node.arg, nodes.Const):
+                keys.insert(0, node.arg.value)
+            else:  # dynamic key, depend on the whole container
+                del keys[:]
+                ok = template_reads(node.arg, roots, reads, files) and ok
+            node = node.node
+        if isinstance(node, nodes.Name) and node.name in roots:
+            reads.add((node.name,) + tuple(keys))
+            return ok
+        return template_reads(node, roots, reads, files) and ok
+    if isinstance(node, nodes.Name) and node.name in roots:
+        reads.add((node.name,))
+        return True
+    ok = True
+    for child in node.iter_child_nodes():
+        ok = template_reads(child, roots, reads, files) and ok
+    return ok
+
+
+def lookup_path(obj, keys):
+    """lookup_path - follow keys from obj without creating missing items
+
+    :param obj: root object, e.g. C
+    :param tuple keys: keys / attributes to follow
+    :return: value found, or None if a key is missing
+    """
+    for key in keys:
+        if isinstance(obj, dict):
+            if key in obj:
+                obj = dict.__getitem__(obj, key)
+            elif isinstance(key, basestring) and hasattr(dict, key):
+                break  # e.g. C.x.items(), depends on all of C.x
+            else:
+                return None
+        else:
+            try:
+                obj = obj[key]
+            except Exception:
+                break  # attribute / method of obj, depends on all of obj
+    return obj
+
+
+def value_digest(obj):
+    """value_digest - stable hash of a (JSON like) value
+
+    :param obj: value to hash, numpy arrays etc. allowed
+    :return: hex digest
+    :rtype: str
+    """
+
+    def default(o):
+        if hasattr(o, 'tobytes'):
+            return "%s%s%s" % (
+                hashlib.sha1(o.tobytes()).hexdigest(),
+                getattr(o, 'dtype', ''),
+                getattr(o, 'shape', ''),
+            )
+        if callable(o):  # repr() would include id()
+            return getattr(o, '__name__', type(o).__name__)
+        return repr(o)
+
+    try:
+        text = json.dumps(obj, sort_keys=True, default=default)
+    except (TypeError, ValueError):
+        text = repr(obj)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def part_cache_key(env, name, context):
+    """part_cache_key - cache key for rendered output of a template
+
+    :param jinja2.Environment env: environment with template
+    :param str name: template name
+    :param dict context: values template will be rendered with
+    :return: key, or None if template's inputs can't be determined
+    :rtype: str
+    """
+    source = env.loader.get_source(env, name)[0]
+    reads = set()
+    files = set()
+    if not template_reads(env.parse(source), set(context), reads, files):
+        return None
+    key = hashlib.sha1(source.encode('utf-8'))
+    for path in sorted(reads, key=repr):
+        key.update(repr(path).encode('utf-8'))
+        value = lookup_path(context[path[0]], path[1:])
+        key.update(value_digest(value).encode('utf-8'))
+    for filepath in sorted(files):
+        if os.path.exists(filepath):
+            with open(filepath, 'rb') as source_file:
+                key.update(source_file.read())
+        else:
+            key.update(b'missing')
+    return key.hexdigest()
 
 
 def get_lines(tree, name):
@@ -1010,22 +2614,85 @@ def get_lines(tree, name):
     return None, None
 
 
+def index_symbols(body, end, prefix, index):
+    """index_symbols - add line spans of names defined in body to index
+
+    Like get_lines(), names in a body take precedence over names in its
+    children, and a span runs up to the next statement.  Names of class
+    members etc. are also added with a prefix, e.g. 'SomeClass.method'.
+
+    :param list body: AST statements
+    :param int end: line number after body, or None for end of file
+    :param str prefix: prefix for names in body
+    :param dict index: {name: (start, end)} to add to
+    """
+    linenos = [i.lineno for i in body]
+    spans = list(zip(linenos, linenos[1:] + [end]))
+    # function and class definitions, then assignments
+    names = [[getattr(i, 'name', None)] for i in body]
+    names += [
+        [getattr(j, 'id', None) for j in getattr(i, 'targets', [])]
+        for i in body
+    ]
+    for name_list, span in zip(names, spans + spans):
+        for name in name_list:
+            if name:
+                index.setdefault(name, span)
+                index.setdefault(prefix + name, span)
+    for node, span in zip(body, spans):
+        childs = getattr(node, 'body', None)
+        if isinstance(childs, list) and childs:
+            name = getattr(node, 'name', None)
+            index_symbols(
+                childs, span[1], prefix + name + '.' if name else prefix, index
+            )
+
+
+def code_index(source):
+    """code_index - {name: (start, end)} line spans for names in a .py
+    file, cached in memory and in CODE_INDEX_PATH, keyed on the file's
+    mtime and size
+
+    :param str source: path to .py file
+    :return: index of names, see index_symbols()
+    :rtype: dict
+    """
+    source = os.path.abspath(source)
+    stat = os.stat(source)
+    key = [stat.st_mtime, stat.st_size]
+    with CODE_INDEX_LOCK:
+        if not CODE_INDEX and os.path.exists(CODE_INDEX_PATH):
+            with open(CODE_INDEX_PATH) as in_:
+                CODE_INDEX.update(json.load(in_))
+        if CODE_INDEX.get(source, {}).get('key') == key:
+            return CODE_INDEX[source]['index']
+
+    with open(source) as in_:
+        tree = ast.parse(in_.read())
+    index = {}
+    index_symbols(tree.body, None, '', index)
+    with CODE_INDEX_LOCK:
+        CODE_INDEX[source] = {'key': key, 'index': index}
+        make_dir(os.path.dirname(CODE_INDEX_PATH))
+        with open(CODE_INDEX_PATH, 'w') as out:
+            json.dump(CODE_INDEX, out)
+    return index
+
+
 def get_code(source, name):
     """get_code - get the lines of code from source that defines name
 
     :param str source: path to .py file
-    :param str name: name to look for
+    :param str name: name to look for, may be qualified, 'Class.method'
     :return: code
     :rtype: str
     """
 
-    text = open(source).read()
-    tree = ast.parse(text)
-    text = text.split('\n')
-
-    start, end = get_lines(tree, name)
-    if not start:
+    index = code_index(source)
+    if name not in index:
         return "FAIL: DID NOT FIND '%s' IN '%s'" % (name, source)
+    start, end = index[name]
+    text = open(source).read().split('\n')
     if end is None:
         end = len(text) + 1  # AstNode.lineno is 1 based
     return '\n'.join(text[start - 1 : end - 1])
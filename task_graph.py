@@ -1,3 +1,20 @@
+"""
+task_graph.py - DOT graph and critical path / bottleneck report for
+doit tasks
+
+    doit list --all -f make.py | sed 's/ .*//' | xargs -L1 doit info -f make.py >doit.info
+    python task_graph.py --durations build/profile.json <doit.info >graph.dot
+
+Task durations come from build/profile.json, see PYPANART_PROFILE in
+README.md, or a JSON file of {"task": seconds}.  With durations, the DOT
+graph shows times and the critical path, and a report listing the
+critical path, estimated speed-up with N workers, and tasks which
+invalidate the most other tasks when they change is written to stderr.
+"""
+
+import argparse
+import heapq
+import json
 import os
 import re
 import sys
@@ -17,36 +34,254 @@ def doit_to_dict(stream):
 
     etc. etc.  This function reads a stream an OrderedDict keyed on name.
     """
-    todo = [i for i in stream]
     ans = OrderedDict()
-    while todo:
-        if not todo[0].strip():
-            del todo[0]
+    cur = key = None
+    value = []  # lines of the current key's value
+    for line in stream:
+        if line[:1].isspace() and key is not None:
+            value.append(line)  # continuation, including blank lines
             continue
-        k, v = todo.pop(0).split(':', 1)
-        if k == 'name':
-            v = eval(v)
-            ans[v] = cur = {}
+        if key is not None:
+            cur[key] = eval(''.join(value))
+            key = None
+        if not line.strip():
             continue
-        while todo and todo[0] and todo[0][0].isspace():
-            v += todo.pop(0)
-        v = eval(v)
-        cur[k] = v
+        k, v = line.split(':', 1)
+        if k == 'name':
+            ans[eval(v)] = cur = {}
+        else:
+            key, value = k, [v]
+    if key is not None:
+        cur[key] = eval(''.join(value))
+    return ans
+
+
+def task_deps(info):
+    """task_deps - tasks each task depends on, via task_dep, setup, and
+    file_dep on other tasks' targets
+
+    :param dict info: from doit_to_dict()
+    :return: {task: set(tasks it depends on)}
+    :rtype: dict
+    """
+    made_by = {}
+    for task, attr in info.items():
+        for filepath in attr.get('targets', []):
+            made_by[os.path.normpath(filepath)] = task
+    deps = OrderedDict()
+    for task, attr in info.items():
+        deps[task] = set()
+        for dep in list(attr.get('task_dep', [])) + list(attr.get('setup', [])):
+            if dep not in info:  # e.g. a group task's sub-tasks
+                dep = dep.split(':', 1)[0]
+            if dep in info and dep != task:
+                deps[task].add(dep)
+        for filepath in attr.get('file_dep', []):
+            dep = made_by.get(os.path.normpath(filepath))
+            if dep is not None and dep != task:
+                deps[task].add(dep)
+    return deps
+
+
+def load_durations(path):
+    """load_durations - task durations from build/profile.json or a JSON
+    {task: seconds} file
+
+    :param str path: path to JSON file
+    :return: {task: seconds}, the longest if a task ran more than once
+    :rtype: dict
+    """
+    with open(path) as in_:
+        data = json.load(in_)
+    if 'events' not in data:
+        return dict((k, float(v)) for k, v in data.items())
+    ans = {}
+    for event in data['events']:
+        if event['category'] == 'task':
+            ans[event['name']] = max(event['wall'], ans.get(event['name'], 0))
     return ans
 
 
-def to_dot(info):
+def topological_order(deps):
+    """topological_order - tasks ordered so dependencies come first
+
+    :param dict deps: from task_deps()
+    :return: task names
+    :rtype: list
+    :raises ValueError: for circular dependencies
+    """
+    waiting = dict((task, len(dep)) for task, dep in deps.items())
+    users = defaultdict(list)
+    for task, dep in deps.items():
+        for i in dep:
+            users[i].append(task)
+    order = [task for task, count in waiting.items() if not count]
+    for task in order:  # order grows as tasks become ready
+        for user in users[task]:
+            waiting[user] -= 1
+            if not waiting[user]:
+                order.append(user)
+    if len(order) != len(deps):
+        raise ValueError(
+            "circular dependencies among %s"
+            % sorted(task for task, count in waiting.items() if count)
+        )
+    return order
+
+
+def analyse(deps, durations, workers=(1, 2, 4, 8), top=10):
+    """analyse - critical path, speed-up, and invalidation analysis
+
+    :param dict deps: from task_deps()
+    :param dict durations: {task: seconds}, missing tasks take 0 seconds
+    :param list workers: worker counts to estimate speed-up for
+    :param int top: number of tasks to list by downstream invalidation
+    :return: analysis, see the code for keys
+    :rtype: dict
+    """
+    order = topological_order(deps)
+    time = dict((task, durations.get(task, 0.0)) for task in order)
+    users = defaultdict(list)
+    for task in order:
+        for dep in deps[task]:
+            users[dep].append(task)
+
+    # earliest finish with unlimited workers, and the path giving it
+    finish, before = {}, {}
+    for task in order:
+        prior = None
+        for dep in deps[task]:
+            if prior is None or finish[dep] > finish[prior]:
+                prior = dep
+        before[task] = prior
+        finish[task] = time[task] + (finish[prior] if prior else 0.0)
+    path = []
+    task = max(order, key=lambda x: finish[x]) if order else None
+    while task is not None:
+        path.append(task)
+        task = before[task]
+    path.reverse()
+
+    # longest time from a task's start to the end, for scheduling priority,
+    # and downstream tasks as bitsets, so it's linear in edges per task
+    remaining, downstream = {}, {}
+    index = dict((task, n) for n, task in enumerate(order))
+    for task in reversed(order):
+        remaining[task] = time[task] + max(
+            [remaining[i] for i in users[task]] or [0.0]
+        )
+        bits = 0
+        for user in users[task]:
+            bits |= downstream[user] | (1 << index[user])
+        downstream[task] = bits
+    counts = dict((task, bin(downstream[task]).count('1')) for task in order)
+    invalidates = []
+    for task in sorted(order, key=lambda x: (-counts[x], x))[:top]:
+        bits, cost = downstream[task], 0.0
+        while bits:
+            low = bits & -bits
+            cost += time[order[low.bit_length() - 1]]
+            bits ^= low
+        invalidates.append((counts[task], cost, task))
+
+    total = sum(time.values())
+    speedup = []
+    for n in workers:
+        makespan = schedule(deps, users, time, remaining, n)
+        speedup.append((n, makespan, total / makespan if makespan else 1.0))
+
+    return {
+        'total': total,
+        'critical_path': path,
+        'critical_time': finish[path[-1]] if path else 0.0,
+        'speedup': speedup,
+        'invalidates': invalidates,
+        'missing': sorted(i for i in order if i not in durations),
+        'time': time,
+    }
+
+
+def schedule(deps, users, time, remaining, workers):
+    """schedule - estimated build time with a number of workers, running
+    ready tasks with the longest remaining path first
+
+    :param dict deps: from task_deps()
+    :param dict users: {task: [tasks depending on it]}
+    :param dict time: {task: seconds}
+    :param dict remaining: {task: longest seconds from start to end}
+    :param int workers: number of workers
+    :return: seconds
+    :rtype: float
+    """
+    waiting = dict((task, len(dep)) for task, dep in deps.items())
+    ready = [(-remaining[t], t) for t, count in waiting.items() if not count]
+    heapq.heapify(ready)
+    running = []  # (finish time, task)
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < workers:
+            task = heapq.heappop(ready)[1]
+            heapq.heappush(running, (now + time[task], task))
+        now, task = heapq.heappop(running)
+        for user in users[task]:
+            waiting[user] -= 1
+            if not waiting[user]:
+                heapq.heappush(ready, (-remaining[user], user))
+    return now
+
+
+def report(analysis):
+    """report - text report of analyse() results
+
+    :param dict analysis: from analyse()
+    :return: report
+    :rtype: str
+    """
+    time = analysis['time']
+    lines = [
+        "Total task time: %.2fs" % analysis['total'],
+        "Critical path: %.2fs" % analysis['critical_time'],
+    ]
+    for task in analysis['critical_path']:
+        lines.append("  %8.2fs  %s" % (time[task], task))
+    lines.append("Estimated speed-up:")
+    for workers, makespan, speedup in analysis['speedup']:
+        lines.append(
+            "  %3d workers: %8.2fs  %.2fx" % (workers, makespan, speedup)
+        )
+    lines.append("Most downstream invalidation (tasks, seconds):")
+    for count, cost, task in analysis['invalidates']:
+        lines.append("  %5d %8.2fs  %s" % (count, cost, task))
+    if analysis['missing']:
+        lines.append(
+            "No duration for %d tasks: %s"
+            % (len(analysis['missing']), ' '.join(analysis['missing']))
+        )
+    return '\n'.join(lines)
+
+
+def to_dot(info, analysis=None):
     ans = ['digraph "G" {']
     label = defaultdict(lambda: dict(count=0, out=0))
     done = set()
+    simp = re.compile(r'[0-9./:]')
+
+    def node(name):
+        return simp.sub('_', os.path.basename(name))
+
+    if analysis:
+        path = analysis['critical_path']
+        critical = set((node(a), node(b)) for a, b in zip(path, path[1:]))
     def link(a, b):
-        simp = re.compile(r'[0-9./:]')
-        ka = simp.sub('_', os.path.basename(a))
-        kb = simp.sub('_' ,os.path.basename(b))
+        ka = node(a)
+        kb = node(b)
         edge = (ka, kb)
         if ka != kb and edge not in done:
             done.add(edge)
-            ans.append("%s -> %s" % edge)
+            if analysis and edge in critical:
+                ans.append("%s -> %s [color=red, penwidth=2]" % edge)
+            else:
+                ans.append("%s -> %s" % edge)
             label[ka]['out'] += 1
         label[ka]['name'] = a
         label[kb]['name'] = b
@@ -57,23 +292,59 @@ def to_dot(info):
         attr = info[task]
         for filepath in attr.get('targets', []):
             link(task, os.path.basename(filepath))
-        task_dep = [i.split(':', 1)[0] for i in attr.get('task_dep', [])]
-        # filter out sub-tasks
+        # sub-tasks not listed are shown as their group, see task_deps()
+        task_dep = [
+            i if i in info else i.split(':', 1)[0]
+            for i in attr.get('task_dep', [])
+        ]
         task_dep = set(i for i in task_dep if i != task)
         [link(dep, task) for dep in task_dep]
+    if analysis:  # critical path edges may not be task_dep edges
+        for edge in critical:
+            if edge not in done:
+                done.add(edge)
+                ans.append("%s -> %s [color=red, penwidth=2]" % edge)
     for k, v in label.items():
         if v['count'] not in (1, v['out']):
-            v = "{name}({count})".format(**v)
+            text = "{name}({count})".format(**v)
         else:
-            v = v['name']
-        ans.append('%s [label="%s"]' % (k, v))
+            text = v['name']
+        extra = ''
+        if analysis and v['name'] in analysis['time']:
+            text += "\\n%.2fs" % analysis['time'][v['name']]
+            if v['name'] in analysis['critical_path']:
+                extra = ', color=red'
+        ans.append('%s [label="%s"%s]' % (k, text, extra))
     ans.append("}")
     return '\n'.join(ans)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="DOT graph of `doit info` output on stdin, with "
+        "critical path analysis if task durations are available"
+    )
+    parser.add_argument(
+        '--durations', default='build/profile.json',
+        help="profile.json from PYPANART_PROFILE, or {task: seconds} JSON",
+    )
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+        help="worker counts to estimate speed-up for",
+    )
+    parser.add_argument(
+        '--top', type=int, default=10,
+        help="tasks to list by downstream invalidation",
+    )
+    opt = parser.parse_args()
+
     info = doit_to_dict(sys.stdin)
-    print(to_dot(info))
+    analysis = None
+    if os.path.exists(opt.durations):
+        durations = load_durations(opt.durations)
+        analysis = analyse(task_deps(info), durations, opt.workers, opt.top)
+        sys.stderr.write(report(analysis) + '\n')
+    print(to_dot(info, analysis))
 
 
 if __name__ == "__main__":
@@ -29,7 +29,7 @@ try:
 except ImportError:
     plt = None
 
-from pypanart import run_task
+from pypanart import run_task, watch
 
 # START: PyPanArt standard tasks
 
@@ -85,8 +85,12 @@ def basic_plot():
 
 
 def main():
-    """run task specified from command line"""
-    run_task(globals(), sys.argv[1])
+    """run task specified from command line, or `watch [task]` to
+    rebuild on changes"""
+    if sys.argv[1] == 'watch':
+        watch(globals(), *sys.argv[2:3])
+    else:
+        run_task(globals(), sys.argv[1])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+"""
+test_chkurls.py - tests for chkurls.py, against a local http.server
+
+Run with `python -m pytest test_chkurls.py`
+"""
+
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from chkurls import LinkChecker
+
+FLAKY_FAILURES = 2  # 503s from /flaky before it works
+
+
+class Handler(BaseHTTPRequestHandler):
+    """/ok works, /nohead only works with GET, /flaky gives 503 at first,
+    /missing is 404, records (method, path) in server.requests"""
+
+    def respond(self, method):
+        with self.server.lock:
+            self.server.requests.append((method, self.path))
+            flaky = sum(1 for i in self.server.requests if i[1] == '/flaky')
+        if self.path == '/ok':
+            status = 200
+        elif self.path == '/nohead':
+            status = 405 if method == 'HEAD' else 200
+        elif self.path == '/flaky':
+            status = 503 if flaky <= FLAKY_FAILURES else 200
+        else:
+            status = 404
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.respond('HEAD')
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    httpd.lock = threading.Lock()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return 'http://127.0.0.1:%d%s' % (server.server_port, path)
+
+
+def checker(tmp_path, **kwargs):
+    return LinkChecker(
+        cache_path=str(tmp_path / 'cache.json'), backoff=0.05, **kwargs
+    )
+
+
+def test_get_fallback(tmp_path, server):
+    info = checker(tmp_path).run([url(server, '/nohead')])[0]
+    assert info['ok'] and info['status'] == 200
+    assert server.requests == [('HEAD', '/nohead'), ('GET', '/nohead')]
+
+
+def test_retry_backoff(tmp_path, server):
+    start = time.time()
+    info = checker(tmp_path, retries=2).run([url(server, '/flaky')])[0]
+    assert info['ok']
+    assert [i[1] for i in server.requests] == ['/flaky'] * 3
+    assert time.time() - start >= 0.05 + 0.1  # backoff doubles
+
+
+def test_retries_exhausted(tmp_path, server):
+    info = checker(tmp_path, retries=1).run([url(server, '/flaky')])[0]
+    assert not info['ok'] and info['status'] == 503
+    assert len(server.requests) == 2
+
+
+def test_negative_ttl(tmp_path, server):
+    urls = [url(server, '/ok'), url(server, '/missing')]
+    first = checker(tmp_path, negative_ttl=60).run(urls)
+    assert [i['ok'] for i in first] == [True, False]
+    assert not any(i['cached'] for i in first)
+
+    # both cached, from the file saved by the first checker
+    again = checker(tmp_path, negative_ttl=60)
+    assert all(i['cached'] for i in again.run(urls))
+
+    # failed URL expires, working URL doesn't
+    later = checker(tmp_path, negative_ttl=60)
+    now = time.time() + 120
+    assert later.cached(urls[0], now) is not None
+    assert later.cached(urls[1], now) is None
+    requests_before = len(server.requests)
+    expired = checker(tmp_path, negative_ttl=0).run(urls)
+    assert [i['cached'] for i in expired] == [True, False]
+    assert len(server.requests) > requests_before
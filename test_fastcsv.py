@@ -0,0 +1,37 @@
+"""
+test_fastcsv.py - tests for fastcsv.py, comparing with numpy.genfromtxt()
+
+Run with `python -m pytest test_fastcsv.py`
+"""
+
+import numpy as np
+import pytest
+
+import fastcsv
+
+BIG = '99999999999999999999999'  # beyond int64
+
+
+def genfromtxt(path):
+    return np.genfromtxt(
+        path, delimiter=',', names=True, dtype=None, encoding='utf-8'
+    )
+
+
+def test_big_int_is_float(tmp_path):
+    path = str(tmp_path / 'big.csv')
+    with open(path, 'w') as out:
+        out.write("a,b\n1,%s\n2,3\n" % BIG)
+    data = fastcsv.read_csv(path)
+    expected = genfromtxt(path)
+    assert data.dtype == expected.dtype
+    assert np.array_equal(data, expected)
+
+
+def test_big_int_after_sample(tmp_path):
+    # sample says int, so conversion fails later, for genfromtxt fallback
+    path = str(tmp_path / 'big.csv')
+    with open(path, 'w') as out:
+        out.write("a,b\n1,2\n2,%s\n" % BIG)
+    with pytest.raises(fastcsv.NotSimpleCSV):
+        fastcsv.read_csv(path, sample_rows=1, chunk_rows=1)
@@ -0,0 +1,108 @@
+"""
+test_fetcher.py - tests for fetcher.py, against a local http.server
+
+Run with `python -m pytest test_fetcher.py`
+"""
+
+import json
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from fetcher import Fetcher
+
+DATA = b"a,b\n1,2\n3,4\n"
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """serve DATA for any path, honoring If-None-Match and Range /
+    If-Range like a real server, records request headers in
+    server.requests"""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        range_ = self.headers.get('Range')
+        if range_ and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(range_.split('=')[1].rstrip('-'))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(DATA))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                'bytes %d-%d/%d' % (start, len(DATA) - 1, len(DATA)),
+            )
+            body = DATA[start:]
+        else:
+            self.send_response(200)
+            body = DATA
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def partial_download(tmp_path, server, part):
+    """set up state as if a download of `part` was interrupted"""
+    url = 'http://127.0.0.1:%d/data.csv' % server.server_port
+    target = str(tmp_path / 'data.csv')
+    with open(target + '.part', 'wb') as out:
+        out.write(part)
+    state_path = str(tmp_path / 'fetch.json')
+    with open(state_path, 'w') as out:
+        json.dump({target: {'url': url, 'partial_of': ETAG}}, out)
+    return Fetcher(state_path), url, target
+
+
+def test_resume(tmp_path, server):
+    fetcher, url, target = partial_download(tmp_path, server, DATA[:5])
+    assert fetcher.fetch(url, target) == 'resumed'
+    assert server.requests[0]['Range'] == 'bytes=5-'
+    with open(target, 'rb') as in_:
+        assert in_.read() == DATA
+    assert not os.path.exists(target + '.part')
+
+
+def test_resume_416_restarts(tmp_path, server):
+    # .part file already complete, so the Range is unsatisfiable
+    fetcher, url, target = partial_download(tmp_path, server, DATA)
+    assert fetcher.fetch(url, target) == 'fetched'
+    assert len(server.requests) == 2
+    assert 'Range' not in server.requests[1]
+    with open(target, 'rb') as in_:
+        assert in_.read() == DATA
+    assert not os.path.exists(target + '.part')
+    assert 'partial_of' not in fetcher.state[target]
+
+
+def test_not_modified(tmp_path, server):
+    fetcher, url, target = partial_download(tmp_path, server, DATA[:5])
+    fetcher.fetch(url, target)
+    assert fetcher.fetch(url, target) == 'not modified'
+    assert server.requests[-1]['If-None-Match'] == ETAG
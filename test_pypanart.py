@@ -0,0 +1,126 @@
+"""
+test_pypanart.py - tests for pypanart.py
+
+Run with `python -m pytest test_pypanart.py`
+"""
+
+import os
+
+import jinja2
+import pytest
+
+import pypanart
+
+
+def render_code(tmp_path):
+    """render a part using the code filter in a new Environment, as in a
+    new build, sharing the bytecode cache with earlier builds"""
+    env = pypanart.get_env(
+        ('test', str(tmp_path), len(pypanart.JINJA_ENVS)),
+        lambda: jinja2.FileSystemLoader(str(tmp_path / 'parts')),
+        {'code': pypanart.io_filter(pypanart.get_code_filter)},
+    )
+    return env.get_template('Code.md').render()
+
+
+def test_code_filter_sees_edits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'parts').mkdir()
+    (tmp_path / 'parts' / 'Code.md').write_text(
+        "{{ 'example.py answer'|code }}\n"
+    )
+    source = tmp_path / 'example.py'
+    source.write_text("def answer():\n    return 42\n")
+    assert 'return 42' in render_code(tmp_path)
+    assert os.listdir(pypanart.JINJA_CACHE)  # template was cached
+
+    source.write_text("def answer():\n    return 43\n")
+    stat = os.stat(str(source))  # make sure code_index() sees a change
+    os.utime(str(source), (stat.st_atime, stat.st_mtime + 10))
+    assert 'return 43' in render_code(tmp_path)
+
+
+def test_lazy_value_attributes():
+    calls = []
+    value = pypanart.LazyValue(lambda: calls.append(1) or 'a title')
+    assert not calls  # not computed until used
+    assert value.upper() == 'A TITLE'
+    assert value.title() == 'A Title'
+    assert calls == [1]
+
+
+def test_user_task():
+    from doit.task import Task
+
+    def plot():
+        pass
+
+    assert pypanart.user_task(Task('plot', [plot]))
+    assert not pypanart.user_task(Task('dir', [(pypanart.make_dir, ('x',))]))
+    assert not pypanart.user_task(Task('shell', ['echo hello']))
+
+
+def test_one_task_name(tmp_path, monkeypatch):
+    import inspect
+
+    monkeypatch.chdir(tmp_path)
+    art = pypanart.PyPanArtState('test', {}, [], bib=['test.bib'])
+    seen = []
+
+    @art.one_task(targets=['out.txt'])
+    def fails(targets):
+        seen.append((pypanart.TASK.name, targets))
+        raise ValueError("task failed")
+
+    action = fails()['actions'][0]
+    assert list(inspect.signature(action).parameters) == ['targets']
+    with pytest.raises(ValueError):
+        action(targets=['out.txt'])
+    assert seen == [('fails', ['out.txt'])]
+    assert pypanart.TASK.name is None  # not left for the next task
+
+
+FAKE_INKSCAPE = """#!%s
+# stand in for `inkscape --shell`, writes 'out' for --export-png="out"
+import sys
+sys.stdout.write('>')
+sys.stdout.flush()
+for line in sys.stdin:
+    if line.strip() == 'quit':
+        break
+    out = line.split('--export-png="')[1].split('"')[0]
+    open(out, 'w').write('png')
+    sys.stdout.write('\\n>')
+    sys.stdout.flush()
+"""
+
+
+def test_inkscape_shells_reused(tmp_path):
+    import sys
+    import threading
+
+    inkscape = tmp_path / 'inkscape'
+    inkscape.write_text(FAKE_INKSCAPE % sys.executable)
+    inkscape.chmod(0o755)
+    inkscape = str(inkscape)
+    results = []
+
+    def export(n):
+        out = str(tmp_path / ('%d.png' % n))
+        results.append(pypanart.inkscape_export(inkscape, 'x.svg', out, 'png'))
+
+    try:
+        for build in range(3):  # new threads each time, like watch()
+            threads = [
+                threading.Thread(target=export, args=(build * 3 + i,))
+                for i in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert results == [True] * 9
+        assert 1 <= len(pypanart.INKSCAPE_SHELLS[inkscape]) <= 3
+    finally:
+        for shell in pypanart.INKSCAPE_SHELLS.pop(inkscape, []):
+            shell.close()